@@ -1,6 +1,6 @@
+import csv
 import os
 import click
-from sqlalchemy import and_
 from flask import Flask, render_template, current_app
 from flask_login import current_user
 from flask_wtf.csrf import CSRFError
@@ -14,14 +14,16 @@ from corneakeeper.blueprints.user import user_bp
 from corneakeeper.blueprints.main import main_bp
 from corneakeeper.blueprints.ajax import ajax_bp
 from corneakeeper.settings import config
-from corneakeeper.models import User, Post, Category, Comment, Link, Role
-from corneakeeper.utils import del_files
+from corneakeeper.models import Role, Timeline, Tag, User, Photo, Post, CorneaAggregate, CorneaTrend, loading_profile
+from corneakeeper.caches import get_template_context, bump_version, TEMPLATE_CONTEXT
+from corneakeeper.utils import del_files, CorneaKeeperRequest
 
 
 def create_app(config_name=None):
     if config_name is None:
         config_name = os.getenv('FLASK_CONFIG', 'development')
     app = Flask('corneakeeper')
+    app.request_class = CorneaKeeperRequest
     app.jinja_env.add_extension('jinja2.ext.loopcontrols')  # jinja2 循环控制
     app.config.from_object(config[config_name])
     register_extensions(app)  # 注册拓展（拓展初始化）
@@ -59,21 +61,12 @@ def register_blueprints(app):
 def register_template_context(app):
     @app.context_processor
     def make_template_context():
-        admin = User.query.first()
-        categories = Category.query.order_by(Category.name).all()
-        links = Link.query.order_by(Link.name).all()
-        if current_user.is_authenticated:
-            if current_user.can('MANAGE'):
-                unread_comments = Comment.query.join(Post).filter(
-                    and_(Comment.reviewed is False, Post.user_id == current_user.id,
-                         Comment.user_id != current_user.id)).count()
-            else:
-                unread_comments = None
+        context = dict(get_template_context())
+        if current_user.is_authenticated and current_user.can('MANAGE'):
+            context.update(unread_comments=current_user.unread_comments)
         else:
-            unread_comments = None
-        return dict(
-            admin=admin, categories=categories,
-            links=links, unread_comments=unread_comments)
+            context.update(unread_comments=None)
+        return context
 
 
 def register_commands(app):
@@ -130,8 +123,327 @@ def register_commands(app):
         click.echo('Generating links...')
         fake_links()
 
+        bump_version(TEMPLATE_CONTEXT)
+
         click.echo('Done.')
 
+    @app.cli.command('rebuild-timeline')
+    def rebuild_timeline():
+        """Rebuild the follow timelines from the follow table."""
+        Timeline.rebuild()
+        click.echo('Rebuilt timelines.')
+
+    @app.cli.command('rebuild-tag-counts')
+    def rebuild_tag_counts():
+        """Recount the photos of every tag."""
+        Tag.reconcile_counts()
+        click.echo('Rebuilt tag counts.')
+
+    @app.cli.command('import-corneas')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--username', help='Import every row for this user instead of the username column.')
+    @click.option('--chunk-size', default=1000, help='Rows per bulk insert, default is 1000.')
+    @click.option('--report', type=click.File('w'), help='Write failed rows to this CSV file.')
+    def import_corneas_command(path, username, chunk_size, report):
+        """Import cornea data from a CSV or XLSX file."""
+        from corneakeeper.importers import import_corneas, iter_rows
+
+        user_id = None
+        if username:
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                click.echo('User not found.')
+                return
+            user_id = user.id
+        writer = csv.writer(report) if report is not None else None
+        if writer is not None:
+            writer.writerow(['line', 'error'])
+
+        def on_error(line, message):
+            if writer is not None:
+                writer.writerow([line, message])
+            else:
+                click.echo('line %d: %s' % (line, message), err=True)
+
+        with open(path, 'rb') as f:
+            imported, failed = import_corneas(iter_rows(f, path), user_id, chunk_size, on_error)
+        click.echo('Imported %d rows, %d failed.' % (imported, failed))
+
+    @app.cli.command('export-corneas')
+    @click.option('--username', multiple=True, help='Export this user only, can be repeated. Default is everyone.')
+    @click.option('--format', 'export_format', default='csv', type=click.Choice(['csv', 'ndjson']),
+                  help='Output format, default is csv.')
+    @click.option('--since', type=click.DateTime(), help='Only rows measured at or after this date.')
+    @click.option('--until', type=click.DateTime(), help='Only rows measured before this date.')
+    @click.option('--after', help='Resume after this "user_id,datetime,id", the last row already exported.')
+    @click.option('--output', type=click.File('w'), default='-', help='Write to this file, default is stdout.')
+    def export_corneas_command(username, export_format, since, until, after, output):
+        """Export cornea data as CSV or NDJSON, streaming row by row."""
+        from corneakeeper.exporters import iter_corneas, generate, parse_position
+
+        try:
+            after = parse_position(after)
+        except ValueError:
+            raise click.BadParameter('expected "user_id,datetime,id"', param_hint='--after')
+        user_ids = None
+        if username:
+            user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.username.in_(username)).all()]
+        for chunk in generate(iter_corneas(user_ids, since, until, after), export_format):
+            output.write(chunk)
+
+    @app.cli.command('recognize')
+    @click.argument('photo_ids', nargs=-1, type=int)
+    @click.option('--username', help='Recognize every photo of this user.')
+    @click.option('--workers', default=None, type=int, help='Concurrent recognitions, default is CK_OCR_WORKERS.')
+    @click.option('--output', type=click.File('w'), help='Write the results to this CSV file for import-corneas.')
+    def recognize_photos(photo_ids, username, workers, output):
+        """OCR photos in one batch, identical images are recognized once."""
+        from corneakeeper.ocr import recognize_many
+        from corneakeeper.utils import get_file_content
+
+        query = Photo.query.options(*loading_profile(Photo, 'list')).order_by(Photo.id)
+        if username:
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                click.echo('User not found.')
+                return
+            query = query.filter(Photo.user_id == user.id)
+        elif photo_ids:
+            query = query.filter(Photo.id.in_(photo_ids))
+        else:
+            click.echo('Give photo ids or --username.')
+            return
+        photos = query.all()
+        upload_path = current_app.config['CK_UPLOAD_PATH']
+        images = [(photo.id, get_file_content(os.path.join(upload_path, photo.filename))) for photo in photos]
+        items = recognize_many(images, workers or current_app.config['CK_OCR_WORKERS'])
+
+        photo_by_id = dict((photo.id, photo) for photo in photos)
+        writer = csv.writer(output) if output is not None else None
+        if writer is not None:
+            writer.writerow(['photo_id', 'username', 'datetime', 'k1', 'k2', 'k_max', 'thickness_min', 'BSCVA', 'UCVA'])
+        click.echo('%8s %-16s %8s %8s %8s %10s  %s' % ('photo', 'user', 'k1', 'k2', 'k_max', 'thickness', 'status'))
+        for item in items:
+            photo, fields = photo_by_id[item.key], item.fields or {}
+            status = 'duplicate of %d' % item.duplicate_of if item.duplicate_of else item.error or ''
+            click.echo('%8d %-16s %8s %8s %8s %10s  %s' % (
+                item.key, photo.user.username, fields.get('k1', ''), fields.get('k2', ''), fields.get('k_max', ''),
+                fields.get('thickness_min', ''), status))
+            if writer is not None and item.fields:
+                writer.writerow([item.key, photo.user.username, photo.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                                 fields['k1'], fields['k2'], fields['k_max'], fields['thickness_min'], '', ''])
+
+    @app.cli.command('rebuild-cornea-aggregates')
+    def rebuild_cornea_aggregates():
+        """Rebuild per-user cornea aggregates from all cornea data."""
+        CorneaAggregate.rebuild()
+        click.echo('Rebuilt cornea aggregates.')
+
+    @app.cli.command('rebuild-cornea-trends')
+    def rebuild_cornea_trends():
+        """Rebuild per-user cornea trends from all cornea data."""
+        CorneaTrend.rebuild()
+        click.echo('Rebuilt cornea trends.')
+
+    def add_missing_columns():
+        from sqlalchemy import inspect, literal
+
+        inspector = inspect(db.engine)
+        tables = set(inspector.get_table_names())
+        dialect = db.engine.dialect
+        quote = dialect.identifier_preparer.quote
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = set(column['name'] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if default is None and not column.nullable:
+                    raise click.ClickException('%s.%s has no default, add it by hand.' % (table.name, column.name))
+                ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (quote(table.name), quote(column.name),
+                                                         column.type.compile(dialect=dialect))
+                if default is not None:
+                    ddl += ' DEFAULT %s' % literal(default, column.type).compile(
+                        dialect=dialect, compile_kwargs={'literal_binds': True})
+                if not column.nullable:
+                    ddl += ' NOT NULL'
+                db.engine.execute(ddl)
+                click.echo('Added column %s.%s.' % (table.name, column.name))
+
+    def create_missing_indexes():
+        from sqlalchemy import inspect
+
+        inspector = inspect(db.engine)
+        tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=db.engine)
+                    click.echo('Created index %s on %s.' % (index.name, table.name))
+        click.echo('Indexes are up to date.')
+
+    # 为已有数据库补建模型中新增的索引，initdb 只创建不存在的表
+    @app.cli.command('create-indexes')
+    def create_indexes():
+        """Create indexes declared on models but missing from the database."""
+        create_missing_indexes()
+
+    # 升级已有数据库：建新表、补新增的列和索引，再根据现有数据重算计数、时间线和角膜汇总，可以重复执行
+    @app.cli.command('upgrade-db')
+    def upgrade_db():
+        """Bring an existing database up to date with the models."""
+        db.create_all()
+        add_missing_columns()
+        create_missing_indexes()
+        for model in (User, Photo, Post, Tag):
+            for column, fixed in model.reconcile_counts().items():
+                click.echo('%s.%s: %d rows fixed.' % (model.__name__, column, fixed))
+        Timeline.rebuild()
+        click.echo('Rebuilt timelines.')
+        CorneaAggregate.rebuild()
+        click.echo('Rebuilt cornea aggregates.')
+        CorneaTrend.rebuild()
+        click.echo('Rebuilt cornea trends.')
+
+    @app.cli.command('reconcile-counters')
+    def reconcile_counters():
+        """Repair drifted counter columns in bulk."""
+        for model in (User, Photo, Post, Tag):
+            for column, fixed in model.reconcile_counts().items():
+                click.echo('%s.%s: %d rows fixed.' % (model.__name__, column, fixed))
+
+    @app.cli.command('screen')
+    @click.option('--language', default='zh', type=click.Choice(['zh', 'en']), help='Rule set, default is zh.')
+    @click.option('--progressing', is_flag=True, help='Only list users whose condition is progressing.')
+    def screen_users(language, progressing):
+        """Stage every user with cornea data in one pass."""
+        from corneakeeper.staging import screen
+
+        usernames = dict(db.session.query(User.id, User.username).all())
+        counts = {}
+        for user_id, stage, progress in screen(language):
+            counts[stage] = counts.get(stage, 0) + 1
+            if progress or not progressing:
+                click.echo('%-20s %-32s %s' % (usernames.get(user_id, user_id), stage,
+                                               'progressing' if progress else ''))
+        click.echo('')
+        for stage, count in sorted(counts.items(), key=lambda item: -item[1]):
+            click.echo('%-32s %8d' % (stage, count))
+
+    @app.cli.group()
+    def benchmark():
+        """Performance benchmark commands."""
+        pass
+
+    @benchmark.command()
+    @click.option('--page', default=10000, help='Deep page to compare with page 1, default is 10000.')
+    @click.option('--repeat', default=20, help='Runs per measurement, default is 20.')
+    @click.option('--forge', 'forge_count', default=0, help='Bulk insert this many posts first, default is 0.')
+    def pagination(page, repeat, forge_count):
+        """Compare OFFSET and cursor pagination latency."""
+        from corneakeeper.benchmarks import bench_pagination
+        from corneakeeper.fakes import fake_bulk_posts
+
+        if forge_count:
+            click.echo('Generating %d posts...' % forge_count)
+            fake_bulk_posts(forge_count)
+
+        per_page = current_app.config['BLOG_POST_PER_PAGE']
+        click.echo('%8s %12s %12s' % ('page', 'offset(ms)', 'cursor(ms)'))
+        for number in (1, page):
+            result = bench_pagination(number, per_page, repeat)
+            if result is None:
+                click.echo('Not enough posts for page %d, use --forge %d.' % (number, number * per_page))
+                continue
+            click.echo('%8d %12.2f %12.2f' % ((number,) + result))
+
+    @benchmark.command()
+    @click.option('--url', 'urls', multiple=True, help='Page to request, can be given multiple times.')
+    @click.option('--username', help='Request as this user, default is the first user.')
+    @click.option('--anonymous', is_flag=True, help='Request without logging in.')
+    def queries(urls, username, anonymous):
+        """Count SQL statements and loaded objects per page."""
+        from corneakeeper.benchmarks import bench_queries, default_urls
+
+        user = None
+        if not anonymous:
+            query = User.query.filter_by(username=username) if username else User.query
+            user = query.first()
+            if user is None:
+                click.echo('User not found.')
+                return
+        with app.test_request_context():
+            urls = urls or default_urls()
+        click.echo('%-40s %6s %10s %10s' % ('url', 'status', 'statements', 'objects'))
+        for result in bench_queries(urls, user):
+            click.echo('%-40s %6d %10d %10d' % result)
+
+    @benchmark.command()
+    @click.option('--language', default='zh', type=click.Choice(['zh', 'en']), help='Rule set, default is zh.')
+    @click.option('--repeat', default=5, help='Runs per measurement, default is 5.')
+    def staging(language, repeat):
+        """Compare the old per-user ORM diagnosis with aggregate-based diagnosis and screening."""
+        from corneakeeper.benchmarks import bench_staging
+
+        users, baseline_ms, loop_ms, batch_ms, mismatches = bench_staging(language, repeat)
+        click.echo('%8s %12s %12s %12s %10s' % ('users', 'baseline(ms)', 'loop(ms)', 'batch(ms)', 'mismatch'))
+        click.echo('%8d %12.2f %12.2f %12.2f %10d' % (users, baseline_ms, loop_ms, batch_ms, mismatches))
+
+    @benchmark.command()
+    @click.option('--username', help='Explain queries for this user, default is the first user.')
+    def explain(username):
+        """Check that cornea queries use indexes, exit with 1 on full scans or sorts."""
+        from corneakeeper.benchmarks import cornea_queries, explain, plan_problems
+
+        query = User.query.filter_by(username=username) if username else User.query
+        user = query.first()
+        if user is None:
+            click.echo('User not found.')
+            return
+        failed = False
+        for name, cornea_query in cornea_queries(user.id):
+            plan = explain(cornea_query)
+            problems = plan_problems(plan)
+            failed = failed or bool(problems)
+            click.echo('%-10s %s' % (name, 'FAIL' if problems else 'ok'))
+            for row in plan:
+                click.echo('    %s' % ' '.join('%s=%s' % item for item in row.items()))
+        if failed:
+            raise SystemExit(1)
+
+    @benchmark.command()
+    @click.option('--count', default=200, help='Distinct images to recognize, default is 200.')
+    @click.option('--workers', default=None, type=int, help='Concurrent requests, default is CK_OCR_WORKERS.')
+    def ocr(count, workers):
+        """Measure OCR throughput and latency with the configured backend."""
+        from corneakeeper.benchmarks import bench_ocr, percentile
+
+        workers = workers or current_app.config['CK_OCR_WORKERS']
+        click.echo('Backend: %s, %d images, %d workers' % (current_app.config['CK_OCR_BACKEND'], count, workers))
+        elapsed, failed, latencies = bench_ocr(count, workers)
+        click.echo('%10s %8s %10s %10s %10s %10s' % ('images/s', 'failed', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'max(ms)'))
+        click.echo('%10.1f %8d %10.1f %10.1f %10.1f %10.1f' % (
+            count / elapsed, failed, percentile(latencies, 50), percentile(latencies, 95),
+            percentile(latencies, 99), latencies[-1] if latencies else 0))
+
+    @benchmark.command()
+    @click.option('--repeat', default=2000, help='Parses per fixture, default is 2000.')
+    def parser(repeat):
+        """Check post_processing against the OCR fixtures and time it, exit with 1 on mismatches."""
+        from corneakeeper.benchmarks import bench_parser
+
+        results = bench_parser(repeat)
+        click.echo('%-36s %6s %6s %10s' % ('fixture', 'lines', 'result', 'us/doc'))
+        for name, lines, ok, micros in results:
+            click.echo('%-36s %6d %6s %10.1f' % (name, lines, 'ok' if ok else 'FAIL', micros))
+        if not all(ok for _, _, ok, _ in results):
+            raise SystemExit(1)
+
     @app.cli.group()
     def translate():
         """Translation and localization commands."""
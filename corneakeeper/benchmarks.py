@@ -0,0 +1,237 @@
+import datetime
+import json
+import os
+import statistics
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, url_for
+from sqlalchemy import event
+
+from corneakeeper.extensions import db
+from corneakeeper.models import Post, Photo, Category, User, Cornea
+from corneakeeper.ocr import recognize, OcrError
+from corneakeeper.utils import post_processing
+from corneakeeper.pagination import keyset_paginate, encode_cursor
+from corneakeeper.staging import diagnose, screen
+
+
+def median_ms(func, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+# 对比 OFFSET 分页与游标分页在指定页的耗时（毫秒）
+def bench_pagination(page, per_page, repeat=20):
+    ordered = Post.query.order_by(Post.timestamp.desc(), Post.id.desc())
+    cursor = None
+    if page > 1:
+        boundary = ordered.offset((page - 1) * per_page - 1).first()
+        if boundary is None:
+            return None
+        cursor = encode_cursor('next', boundary)
+    offset_ms = median_ms(lambda: ordered.paginate(page, per_page, error_out=False), repeat)
+    cursor_ms = median_ms(lambda: keyset_paginate(Post.query, Post, cursor, per_page), repeat)
+    return offset_ms, cursor_ms
+
+
+# 改用汇总表之前诊断页面的做法：加载该用户全部角膜数据的 ORM 对象，再逐条计算分期，作为对比的基准
+def baseline_stage(user_id, language):
+    cornea = Cornea.query.filter(Cornea.user_id == user_id).order_by(Cornea.datetime).all()
+    if not cornea:
+        return None
+    k_max, thickness = [c.k_max for c in cornea], [c.thickness_min for c in cornea]
+    bscva, is_max = max(c.BSCVA for c in cornea), max(abs(c.k1 - c.k2) for c in cornea)
+    myopia, astigmatism = max(c.myopia for c in cornea), max(c.astigmatism for c in cornea)
+    if language == 'zh':
+        if bscva >= 1.0:
+            return '潜伏期' if is_max > 1.4 else '正常'
+        if bscva >= 0.8:
+            return '初发期' if is_max > 1.4 else '正常'
+        if bscva >= 0.3:
+            return '完成期 1 级' if min(thickness) > 400 and max(k_max) < 53 else '初发期'
+        if bscva >= 0.05:
+            return '完成期 2 级' if min(thickness) > 300 and max(k_max) < 55 else '完成期 1 级'
+        return '完成期 3 级' if min(thickness) <= 300 and max(k_max) > 55 else '完成期 2 级'
+    if min(thickness) >= 400:
+        if max(k_max) > 48 and myopia < 500 and astigmatism < 500:
+            return 'Early Keratoconus (Stage 1)'
+        return 'Normal'
+    if min(thickness) >= 300:
+        if max(k_max) <= 53:
+            return 'Normal'
+        if 800 <= myopia <= 1000 and 800 <= astigmatism <= 1000:
+            return 'Advanced Keratoconus (Stage 3)'
+        if 500 <= myopia < 800 and 500 <= astigmatism < 800:
+            return 'Moderate Keratoconus (Stage 2)'
+        return 'Early Keratoconus (Stage 1)'
+    return 'Severe Keratoconus (Stage 4)' if max(k_max) > 55 else 'Advanced Keratoconus (Stage 3)'
+
+
+# 对比三种分期方式的耗时（毫秒）：改动前逐个用户加载全部角膜数据、逐个用户读取汇总表（诊断页面）、
+# 一次读取全部汇总表（flask screen），并返回汇总表与基准分期结果不一致的用户数
+def bench_staging(language, repeat=5):
+    user_ids = [user_id for user_id, in db.session.query(Cornea.user_id).filter(
+        Cornea.user_id.isnot(None)).distinct().all()]
+    baseline = dict((user_id, baseline_stage(user_id, language)) for user_id in user_ids)
+    mismatches = sum(1 for user_id, stage, _ in screen(language) if baseline.get(user_id) != stage)
+    baseline_ms = median_ms(lambda: [baseline_stage(user_id, language) for user_id in user_ids], repeat)
+    loop_ms = median_ms(lambda: [diagnose(user_id, language) for user_id in user_ids], repeat)
+    batch_ms = median_ms(lambda: screen(language), repeat)
+    return len(user_ids), baseline_ms, loop_ms, batch_ms, mismatches
+
+
+# 统计代码块内执行的 SQL 语句数和加载的 ORM 对象数
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = 0
+        self.objects = 0
+
+    def _count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def _count_object(self, target, context):
+        self.objects += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count_statement)
+        event.listen(db.Model, 'load', self._count_object, propagate=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self._count_statement)
+        event.remove(db.Model, 'load', self._count_object)
+
+
+def default_urls():
+    urls = [url_for('main.index'), url_for('main.explore'), url_for('blog.index')]
+    user, post, photo, category = User.query.first(), Post.query.first(), Photo.query.first(), Category.query.first()
+    if user is not None:
+        urls += [url_for('user.index', username=user.username),
+                 url_for('user.show_photos', username=user.username),
+                 url_for('user.show_collections', username=user.username),
+                 url_for('user.show_followers', username=user.username),
+                 url_for('user.show_following', username=user.username)]
+    if post is not None:
+        urls.append(url_for('blog.show_post', post_id=post.id))
+    if photo is not None:
+        urls.append(url_for('main.show_photo', photo_id=photo.id))
+    if category is not None:
+        urls.append(url_for('blog.show_category', category_id=category.id))
+    return urls
+
+
+def _request_all(app, engine, urls, user_id, results):
+    client = app.test_client()
+    if user_id is not None:
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+    for url in urls:
+        client.get(url)
+        with QueryCounter(engine) as counter:
+            response = client.get(url)
+        results.append((url, response.status_code, counter.statements, counter.objects))
+
+
+# 逐个请求页面，返回 (url, 状态码, SQL 语句数, ORM 对象数)，每个页面先请求一次预热进程内缓存再统计
+# 请求在独立线程中发起，保证每个请求都有自己的应用上下文和数据库会话
+def bench_queries(urls, user=None):
+    results = []
+    worker = threading.Thread(target=_request_all, args=(
+        current_app._get_current_object(), db.engine, urls, user.id if user is not None else None, results))
+    worker.start()
+    worker.join()
+    return results
+
+
+# 角膜数据的主要查询，与历史记录、图表、修改/删除和导出使用的条件一致
+def cornea_queries(user_id):
+    since = datetime.datetime(2000, 1, 1)
+    return [
+        ('history', Cornea.query.filter(Cornea.user_id == user_id).order_by(Cornea.datetime.desc())),
+        ('series', db.session.query(Cornea.datetime, Cornea.k_max).filter(
+            Cornea.user_id == user_id).order_by(Cornea.datetime)),
+        ('by id', Cornea.query.filter_by(id=1, user_id=user_id)),
+        ('export', db.session.query(Cornea.datetime).filter(Cornea.user_id.in_([user_id]), Cornea.datetime >= since)
+         .order_by(Cornea.user_id, Cornea.datetime, Cornea.id)),
+    ]
+
+
+# 返回查询计划的每一行，SQLite 使用 EXPLAIN QUERY PLAN，其他数据库使用 EXPLAIN
+def explain(query):
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    result = db.session.connection().execute(prefix + str(compiled), params)
+    return [dict(zip(result.keys(), row)) for row in result]
+
+
+# 查询计划中是否有全表扫描或额外排序
+def plan_problems(plan):
+    problems = []
+    for row in plan:
+        if 'detail' in row:
+            detail = row['detail']
+            if detail.startswith('SCAN') and 'INDEX' not in detail:
+                problems.append(detail)
+            if 'TEMP B-TREE' in detail:
+                problems.append(detail)
+        else:
+            if row.get('type') == 'ALL':
+                problems.append('full scan on %s' % row.get('table'))
+            if 'filesort' in (row.get('Extra') or ''):
+                problems.append('filesort on %s' % row.get('table'))
+    return problems
+
+
+def _recognize_timed(app, image):
+    with app.app_context():
+        start = time.perf_counter()
+        try:
+            recognize(image)
+            failed = False
+        except OcrError:
+            failed = True
+        return time.perf_counter() - start, failed
+
+
+# 用 workers 个线程识别 count 张不同的图片（不命中结果缓存），
+# 返回 (总耗时秒数, 失败数, 按从小到大排序的每次耗时毫秒数)
+def bench_ocr(count, workers):
+    app = current_app._get_current_object()
+    images = [os.urandom(1024) for _ in range(count)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda image: _recognize_timed(app, image), images))
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(failed for _, failed in results), sorted(seconds * 1000 for seconds, _ in results)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+# 用识别结果样本检查 post_processing 的输出，并测量每份结果的解析耗时（微秒）
+# 返回 [(样本名, 行数, 输出是否与记录一致, 耗时)]
+def bench_parser(repeat=2000):
+    with open(current_app.config['CK_OCR_FAKE_FIXTURES'], encoding='utf-8') as f:
+        fixtures = json.load(f)
+    results = []
+    for fixture in fixtures:
+        ok = post_processing(fixture) == fixture['fields']
+        seconds = timeit.timeit(lambda: post_processing(fixture), number=repeat) / repeat
+        results.append((fixture['name'], len(fixture['words_result']), ok, seconds * 1e6))
+    return results
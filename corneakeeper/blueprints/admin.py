@@ -1,9 +1,11 @@
-from flask import render_template, flash, redirect, url_for, request, Blueprint
+from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint
 from flask_login import login_required
 from flask_babel import _
 from corneakeeper.extensions import db
 from corneakeeper.forms.admin import CategoryForm, LinkForm
-from corneakeeper.models import Category, Link
+from corneakeeper.models import Category, Link, User, CorneaTrend
+from corneakeeper.caches import bump_version, TEMPLATE_CONTEXT
+from corneakeeper.exporters import export_response, parse_range, parse_after
 
 from corneakeeper.decorators import permission_required
 
@@ -27,6 +29,7 @@ def new_category():
         category = Category(name=name)
         db.session.add(category)
         db.session.commit()
+        bump_version(TEMPLATE_CONTEXT)
         flash(_('分类创建成功'), 'success')
         return redirect(url_for('.manage_category'))
     return render_template('admin/new_category.html', form=form)
@@ -44,6 +47,7 @@ def edit_category(category_id):
     if form.validate_on_submit():
         category.name = form.name.data
         db.session.commit()
+        bump_version(TEMPLATE_CONTEXT)
         flash(_('分类修改成功'), 'success')
         return redirect(url_for('admin.manage_category'))
     form.name.data = category.name
@@ -59,6 +63,7 @@ def delete_category(category_id):
         flash(_('你不能删除默认分类'), 'warning')
         return redirect(url_for('blog.index'))
     category.delete()
+    bump_version(TEMPLATE_CONTEXT)
     flash(_('分类已删除'), 'success')
     return redirect(url_for('.manage_category'))
 
@@ -81,6 +86,7 @@ def new_link():
         link = Link(name=name, url=url)
         db.session.add(link)
         db.session.commit()
+        bump_version(TEMPLATE_CONTEXT)
         flash(_('链接创建成功'), 'success')
         return redirect(url_for('.manage_link'))
     return render_template('admin/new_link.html', form=form)
@@ -96,6 +102,7 @@ def edit_link(link_id):
         link.name = form.name.data
         link.url = form.url.data
         db.session.commit()
+        bump_version(TEMPLATE_CONTEXT)
         flash(_('链接已修改'), 'success')
         return redirect(url_for('.manage_link'))
     form.name.data = link.name
@@ -110,5 +117,33 @@ def delete_link(link_id):
     link = Link.query.get_or_404(link_id)
     db.session.delete(link)
     db.session.commit()
+    bump_version(TEMPLATE_CONTEXT)
     flash(_('链接已删除'), 'success')
     return redirect(url_for('.manage_link'))
+
+
+# 导出选定用户的角膜数据，username 参数可以重复，不指定时导出全部用户；after 参数从中断的位置继续导出
+@admin_bp.route('/cornea/export')
+@login_required
+@permission_required('ADMINISTER')
+def export_corneas():
+    usernames = request.args.getlist('username')
+    user_ids = None
+    if usernames:
+        user_ids = [user_id for user_id, in db.session.query(User.id).filter(User.username.in_(usernames)).all()]
+    return export_response(user_ids, request.args.get('format', 'csv'),
+                           since=parse_range(request.args.get('since')),
+                           until=parse_range(request.args.get('until')),
+                           after=parse_after(request.args.get('after')))
+
+
+# 病情正在进展的用户，直接读取增量维护的趋势表，按最大曲率的年变化量排序
+@admin_bp.route('/cornea/progressing')
+@login_required
+@permission_required('ADMINISTER')
+def progressing_users():
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['CK_USER_PER_PAGE']
+    pagination = db.session.query(CorneaTrend, User).join(User, User.id == CorneaTrend.user_id).filter(
+        CorneaTrend.progressing.is_(True)).order_by(CorneaTrend.k_max_slope.desc()).paginate(page, per_page)
+    return render_template('admin/progressing_users.html', pagination=pagination, trends=pagination.items)
@@ -1,7 +1,8 @@
 from flask import render_template, jsonify, request, Blueprint
 from flask_login import current_user
 
-from corneakeeper.models import User, Photo, Notification
+from corneakeeper.models import User, Photo, Notification, OcrJob
+from corneakeeper.ocr import cached_fields
 from corneakeeper.notifications import push_collect_photo_notification, push_follow_notification
 
 ajax_bp = Blueprint('ajax', __name__)
@@ -16,6 +17,17 @@ def notifications_count():
     return jsonify(count=count)
 
 
+# 识别任务的状态，完成后一并返回解析出的数据
+@ajax_bp.route('/ocr-jobs/<int:job_id>')
+def ocr_job(job_id):
+    if not current_user.is_authenticated:
+        return jsonify(message='Login required.'), 403
+
+    job = OcrJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    fields = cached_fields(job.digest) if job.status == 'done' else None
+    return jsonify(status=job.status, error=job.error, fields=fields)
+
+
 @ajax_bp.route('/profile/<int:user_id>')
 def get_profile(user_id):
     user = User.query.get_or_404(user_id)
@@ -25,14 +37,14 @@ def get_profile(user_id):
 @ajax_bp.route('/followers-count/<int:user_id>')
 def followers_count(user_id):
     user = User.query.get_or_404(user_id)
-    count = user.followers.count() - 1  # minus user self
+    count = user.follower_count
     return jsonify(count=count)
 
 
 @ajax_bp.route('/<int:photo_id>/followers-count')
 def collectors_count(photo_id):
     photo = Photo.query.get_or_404(photo_id)
-    count = len(photo.collectors)
+    count = photo.collector_count
     return jsonify(count=count)
 
 
@@ -5,8 +5,9 @@ from flask_babel import _
 from corneakeeper.emails import send_new_comment_email, send_new_reply_email
 from corneakeeper.extensions import db
 from corneakeeper.forms.blog import CommentForm, UserCommentForm
-from corneakeeper.models import Post, Category, Comment, User, Tag, Photo
+from corneakeeper.models import Post, Category, Comment, User, Tag, Photo, loading_profile
 from corneakeeper.utils import redirect_back
+from corneakeeper.pagination import paginate
 from corneakeeper.notifications import push_collect_post_notification
 from corneakeeper.decorators import confirm_required, permission_required
 
@@ -17,8 +18,8 @@ blog_bp = Blueprint('blog', __name__)
 def index():
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLOG_POST_PER_PAGE']
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page,
-                                                                     per_page=per_page)
+    query = Post.query.options(*loading_profile(Post, 'list'))
+    pagination = paginate(query, Post, page, per_page, cursor=request.args.get('cursor'))
     posts = pagination.items
     return render_template('blog/index.html', pagination=pagination, posts=posts)
 
@@ -33,15 +34,15 @@ def show_category(category_id):
     category = Category.query.get_or_404(category_id)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLOG_POST_PER_PAGE']
-    pagination = Post.query.with_parent(category).order_by(
-        Post.timestamp.desc()).paginate(page, per_page)
+    query = Post.query.with_parent(category).options(*loading_profile(Post, 'list'))
+    pagination = paginate(query, Post, page, per_page, cursor=request.args.get('cursor'))
     posts = pagination.items
     return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
 
 
 @blog_bp.route('/post/<int:post_id>', methods=['GET', 'POST'])
 def show_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(*loading_profile(Post, 'detail')).get_or_404(post_id)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLOG_COMMENT_PER_PAGE']
     pagination = Comment.query.with_parent(post).filter_by(
@@ -81,6 +82,8 @@ def show_post(post_id):
             replied_comment = Comment.query.get_or_404(replied_id)
             comment.replied = replied_comment
             send_new_reply_email(template='emails/new_reply', comment=replied_comment)
+        Comment.count_unread([comment], 1)
+        post.comment_count = Post.comment_count + 1
         db.session.add(comment)
         db.session.commit()
         if current_user.is_authenticated:  # send message based on authentication status
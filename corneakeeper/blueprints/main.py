@@ -1,16 +1,19 @@
+import random
+
 from flask import render_template, flash, redirect, url_for, current_app, \
     send_from_directory, request, abort, Blueprint
 from flask_login import login_required, current_user
-from sqlalchemy.sql.expression import func
 
 from corneakeeper.decorators import confirm_required, permission_required
 from corneakeeper.extensions import db
 from corneakeeper.forms.main import DescriptionForm, TagForm, CommentForm
 from corneakeeper.models import Photo, Tag, Follow, CollectPhoto, Comment, \
-    Notification
+    Notification, Timeline, loading_profile, tagging
 from corneakeeper.notifications import push_comment_notification, \
     push_collect_photo_notification
 from corneakeeper.utils import flash_errors
+from corneakeeper.pagination import paginate, merge_keyset_paginate
+from corneakeeper.caches import sample_photo_ids
 
 main_bp = Blueprint('main', __name__)
 
@@ -18,26 +21,33 @@ main_bp = Blueprint('main', __name__)
 @main_bp.route('/')
 def index():
     if current_user.is_authenticated:
-        page = request.args.get('page', 1, type=int)
         per_page = current_app.config['CK_PHOTO_PER_PAGE']
-        pagination = Photo.query \
-            .join(Follow, Follow.followed_id == Photo.user_id) \
-            .filter(Follow.follower_id == current_user.id) \
-            .order_by(Photo.timestamp.desc()) \
-            .paginate(page, per_page)
+        cursor = request.args.get('cursor')
+        if cursor is not None or current_app.config['CK_CURSOR_PAGINATION']:
+            pagination = merge_keyset_paginate(Timeline.feed_sources(current_user), cursor=cursor, per_page=per_page)
+        else:
+            page = request.args.get('page', 1, type=int)
+            pagination = Photo.query.options(*loading_profile(Photo, 'list')) \
+                .join(Follow, Follow.followed_id == Photo.user_id) \
+                .filter(Follow.follower_id == current_user.id) \
+                .order_by(Photo.timestamp.desc(), Photo.id.desc()) \
+                .paginate(page, per_page)
         photos = pagination.items
     else:
         pagination = None
         photos = None
-    tags = Tag.query.join(Tag.photos).group_by(Tag.id).order_by(
-        func.count(Photo.id).desc()).limit(10)
+    tags = Tag.query.filter(Tag.photo_count > 0).order_by(Tag.photo_count.desc()).limit(10)
     return render_template('main/index.html', pagination=pagination,
                            photos=photos, tags=tags, CollectPhoto=CollectPhoto)
 
 
 @main_bp.route('/explore')
 def explore():
-    photos = Photo.query.order_by(func.random()).limit(12)
+    photo_ids = sample_photo_ids(current_app.config['CK_PHOTO_PER_PAGE'],
+                                 weighted=current_app.config['CK_EXPLORE_BY_COLLECTS'])
+    photos = Photo.query.options(*loading_profile(Photo, 'list')).filter(
+        Photo.id.in_(photo_ids)).all() if photo_ids else []
+    random.shuffle(photos)
     return render_template('main/explore.html', photos=photos)
 
 
@@ -135,7 +145,7 @@ def get_avatar(filename):
 
 @main_bp.route('/photo/<int:photo_id>')
 def show_photo(photo_id):
-    photo = Photo.query.get_or_404(photo_id)
+    photo = Photo.query.options(*loading_profile(Photo, 'detail')).get_or_404(photo_id)
     if current_user != photo.user and photo.user.public_photos is False:
         abort(403)
     page = request.args.get('page', 1, type=int)
@@ -263,7 +273,7 @@ def show_collectors(photo_id):
     photo = Photo.query.get_or_404(photo_id)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_USER_PER_PAGE']
-    pagination = CollectPhoto.query.with_parent(photo).order_by(
+    pagination = CollectPhoto.query.with_parent(photo).options(*loading_profile(CollectPhoto, 'list')).order_by(
         CollectPhoto.timestamp.asc()).paginate(page, per_page)
     collects = pagination.items
     return render_template('main/collectors.html', collects=collects,
@@ -301,6 +311,7 @@ def new_comment(photo_id):
         body = form.body.data
         user = current_user._get_current_object()
         comment = Comment(body=body, user=user, photo=photo)
+        photo.comment_count = Photo.comment_count + 1
         replied_id = request.args.get('reply')
         if replied_id:
             comment.replied = Comment.query.get_or_404(replied_id)
@@ -339,6 +350,7 @@ def new_tag(photo_id):
                 db.session.commit()
             if tag not in photo.tags:
                 photo.tags.append(tag)
+                tag.photo_count = Tag.photo_count + 1
                 db.session.commit()
         flash('Tag added.', 'success')
 
@@ -380,6 +392,10 @@ def delete_photo(photo_id):
     if current_user != photo.user:
         abort(403)
 
+    Timeline.remove_photo(photo)
+    Comment.count_unread([reply for comment in photo.comments for reply in comment.thread()], -1)
+    for tag in photo.tags:
+        tag.photo_count = Tag.photo_count - 1
     db.session.delete(photo)
     db.session.commit()
     if request.cookies.get('language', 'cn') == 'cn':
@@ -406,6 +422,10 @@ def delete_comment(comment_id):
     if current_user != comment.user and current_user != comment.photo.user \
             and not current_user.can('MODERATE'):
         abort(403)
+    thread = list(comment.thread())
+    Comment.count_unread(thread, -1)
+    if comment.photo is not None:
+        comment.photo.comment_count = Photo.comment_count - len(thread)
     db.session.delete(comment)
     db.session.commit()
     if request.cookies.get('language', 'cn') == 'cn':
@@ -421,14 +441,19 @@ def show_tag(tag_id, order):
     tag = Tag.query.get_or_404(tag_id)
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['CK_PHOTO_PER_PAGE']
-    order_rule = 'time'
-    pagination = Photo.query.with_parent(tag).order_by(
-        Photo.timestamp.desc()).paginate(page, per_page)
-    photos = pagination.items
-
+    query = Photo.query.with_parent(tag).options(*loading_profile(Photo, 'list'))
     if order == 'by_collects':
-        photos.sort(key=lambda x: len(x.collectors), reverse=True)
+        # 按 tagging 上的收藏数副本排序，过滤和排序都由 ix_tagging_tag_collects 完成；翻页期间收藏数变化的图片可能跳过或重复
         order_rule = 'collects'
+        query = Photo.query.options(*loading_profile(Photo, 'list')).join(
+            tagging, tagging.c.photo_id == Photo.id).filter(tagging.c.tag_id == tag.id)
+        pagination = paginate(query, Photo, page, per_page, cursor=request.args.get('cursor'),
+                              column=tagging.c.collector_count, item_id=tagging.c.photo_id)
+    else:
+        order_rule = 'time'
+        pagination = paginate(query, Photo, page, per_page,
+                              cursor=request.args.get('cursor'), column=Photo.timestamp)
+    photos = pagination.items
     return render_template('main/tag.html', tag=tag, pagination=pagination,
                            photos=photos, order_rule=order_rule)
 
@@ -441,9 +466,10 @@ def delete_tag(photo_id, tag_id):
     if current_user != photo.user and not current_user.can('MODERATE'):
         abort(403)
     photo.tags.remove(tag)
+    tag.photo_count = Tag.photo_count - 1
     db.session.commit()
 
-    if not tag.photos:
+    if tag.photo_count <= 0:
         db.session.delete(tag)
         db.session.commit()
     if request.cookies.get('language', 'cn') == 'cn':
@@ -4,25 +4,30 @@ from flask import render_template, redirect, url_for, flash, request, \
     current_app, Blueprint, abort
 from flask_login import current_user, fresh_login_required, login_required, \
     logout_user
-from flask_babel import _
-from pyecharts import options as opts
-from pyecharts.globals import ThemeType
-from pyecharts.charts import Line
+from flask_babel import _, get_locale
 from corneakeeper.decorators import confirm_required, permission_required
 from corneakeeper.forms.user import DeleteAccountForm, UploadAvatarForm, CropAvatarForm, \
     EditProfileForm, ChangePasswordForm, \
-    ChangeEmailForm, NotificationSettingForm, PrivacySettingForm, ChangeDataForm
+    ChangeEmailForm, NotificationSettingForm, PrivacySettingForm, ChangeDataForm, ImportCorneaForm, \
+    BatchRecognitionForm
 from corneakeeper.forms.blog import PostForm
 from corneakeeper.extensions import db, avatars
 from corneakeeper.utils import generate_token, validate_token, flash_errors, \
-    get_file_content, post_processing, redirect_back, \
-    rename_image, resize_image, treat
+    get_file_content, redirect_back, \
+    rename_image, resize_image
 from corneakeeper.emails import send_change_email_email
 from corneakeeper.settings import Operations
 from corneakeeper.models import User, Photo, Cornea, Post, Category, Comment, \
-    CollectPhoto, CollectPost
+    CollectPhoto, CollectPost, Follow, Timeline, loading_profile
 from corneakeeper.notifications import push_follow_notification
-from aip import AipOcr
+from corneakeeper.caches import bump_version, get_template_context, TEMPLATE_CONTEXT, POST_COUNTS, chart_etag, \
+    get_chart_payload, get_series, get_cornea_version
+from corneakeeper.pagination import paginate
+from corneakeeper.charts import CHARTS
+from corneakeeper.staging import diagnose
+from corneakeeper.importers import import_corneas, iter_rows
+from corneakeeper.exporters import export_response, parse_range, parse_after
+from corneakeeper.ocr import submit, submit_many, OcrError
 import datetime as dt
 
 user_bp = Blueprint('user', __name__)
@@ -76,8 +81,9 @@ def show_photos(username):
 
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['CK_PHOTO_PER_PAGE']
-    pagination = Photo.query.with_parent(user).order_by(
-        Photo.timestamp.desc()).paginate(page, per_page)
+    query = Photo.query.with_parent(user).options(*loading_profile(Photo, 'list'))
+    pagination = paginate(query, Photo, page, per_page,
+                          cursor=request.args.get('cursor'))
     photos = pagination.items
     return render_template('user/profile/photos.html', user=user, pagination=pagination, photos=photos)
 
@@ -87,7 +93,7 @@ def show_collections(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['CK_PHOTO_PER_PAGE']
-    pagination = CollectPhoto.query.with_parent(user).order_by(
+    pagination = CollectPhoto.query.with_parent(user).options(*loading_profile(CollectPhoto, 'list')).order_by(
         CollectPhoto.timestamp.desc()).paginate(page, per_page)
     collects = pagination.items
     return render_template('user/profile/collections.html', user=user, pagination=pagination, collects=collects)
@@ -98,7 +104,7 @@ def show_followers(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['CK_USER_PER_PAGE']
-    pagination = user.followers.paginate(page, per_page)
+    pagination = user.followers.options(*loading_profile(Follow, 'list')).paginate(page, per_page)
     follows = pagination.items
     return render_template('user/profile/followers.html', user=user, pagination=pagination, follows=follows)
 
@@ -108,19 +114,16 @@ def show_following(username):
     user = User.query.filter_by(username=username).first_or_404()
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['CK_USER_PER_PAGE']
-    pagination = user.following.paginate(page, per_page)
+    pagination = user.following.options(*loading_profile(Follow, 'list')).paginate(page, per_page)
     follows = pagination.items
     return render_template('user/profile/following.html', user=user, pagination=pagination, follows=follows)
 
 
+# 识别在后台线程中进行，未完成时页面轮询任务状态，完成后刷新页面填入识别结果
 @user_bp.route('/<int:photo_id>/recognition', methods=['GET', 'POST'])
+@login_required
 def recognition(photo_id):
     photo = Photo.query.filter_by(id=photo_id).first_or_404()
-    client = AipOcr(os.getenv('APP_ID'), os.getenv('API_KEY'),
-                    os.getenv('BAIDU_SECRET_KEY'))
-    path = current_app.config['CK_UPLOAD_PATH'] + '/' + photo.filename
-    image = get_file_content(path)
-    result = client.basicGeneral(image)
     form = ChangeDataForm()
     if form.validate_on_submit():
         datetime = form.datetime.data
@@ -133,13 +136,22 @@ def recognition(photo_id):
         UCVA = form.UCVA.data
         cornea = Cornea(datetime=datetime, updatetime=updatetime, k1=k1, k2=k2,
                         k_max=k_max,
-                        thickness_min=thickness_min, BSCVA=BSCVA, UCVA=UCVA)
+                        thickness_min=thickness_min, BSCVA=BSCVA, UCVA=UCVA,
+                        user=current_user._get_current_object())
         db.session.add(cornea)
+        current_user.bump_cornea_version()
         db.session.commit()
         flash(_('数据上传成功'), 'success')
         flash('Data created.', 'success')
         return redirect(url_for('user.index', username=current_user.username))
-    recognition = post_processing(result)
+    path = current_app.config['CK_UPLOAD_PATH'] + '/' + photo.filename
+    try:
+        recognition, job = submit(get_file_content(path), photo.id, current_user.id)
+    except OcrError as e:
+        flash(_('识别失败：%(error)s', error=str(e)), 'warning')
+        return redirect(url_for('main.show_photo', photo_id=photo.id))
+    if job is not None:
+        return render_template('user/profile/recognition.html', form=form, job=job)
     form.updatetime.data = dt.datetime.now()
     form.k1.data = recognition['k1']
     form.k2.data = recognition['k2']
@@ -148,83 +160,58 @@ def recognition(photo_id):
     return render_template('user/profile/recognition.html', form=form)
 
 
+# 批量识别：为选中的图片（默认为最近上传的一批）提交识别任务，内容相同的图片只识别一次，
+# 识别结果汇总成一张表，页面轮询任务并填入结果，勾选确认的行一起保存
+@user_bp.route('/recognition/batch', methods=['GET', 'POST'])
+@login_required
+def batch_recognition():
+    form = BatchRecognitionForm()
+    if form.validate_on_submit():
+        updatetime = dt.datetime.now()
+        saved = 0
+        for row in form.rows:
+            if not row.confirm.data:
+                continue
+            db.session.add(Cornea(datetime=row.datetime.data, updatetime=updatetime, k1=row.k1.data, k2=row.k2.data,
+                                  k_max=row.k_max.data, thickness_min=row.thickness_min.data, BSCVA=row.BSCVA.data,
+                                  UCVA=row.UCVA.data, user=current_user._get_current_object()))
+            saved += 1
+        if saved:
+            current_user.bump_cornea_version()
+            db.session.commit()
+        flash(_('成功保存 %(count)d 条数据', count=saved), 'success')
+        return redirect(url_for('.index', username=current_user.username))
+
+    query = Photo.query.filter_by(user_id=current_user.id)
+    items = []
+    if request.method == 'POST':
+        photo_ids = [int(row.photo_id.data) for row in form.rows if row.photo_id.data.isdigit()]
+        photos = query.filter(Photo.id.in_(photo_ids)).all()
+    else:
+        photo_ids = request.args.getlist('photo_id', type=int)
+        if photo_ids:
+            photos = query.filter(Photo.id.in_(photo_ids)).order_by(Photo.id).all()
+        else:
+            photos = query.order_by(Photo.timestamp.desc()).limit(current_app.config['DROPZONE_MAX_FILES']).all()
+        upload_path = current_app.config['CK_UPLOAD_PATH']
+        items = submit_many([(photo.id, get_file_content(os.path.join(upload_path, photo.filename)))
+                             for photo in photos], current_user.id)
+        photo_by_id = dict((photo.id, photo) for photo in photos)
+        for item in items:
+            if item.duplicate_of is None:
+                fields = item.fields or {}
+                form.rows.append_entry(dict(photo_id=item.key, confirm=bool(fields) and all(fields.values()),
+                                            datetime=photo_by_id[item.key].timestamp, **fields))
+    return render_template('user/profile/batch_recognition.html', form=form,
+                           photos=dict((photo.id, photo) for photo in photos),
+                           items=dict((item.key, item) for item in items))
+
+
 @user_bp.route('/<username>/diagnosis')  # 诊断函数
 def diagnosis(username):
     user = User.query.filter_by(username=username).first_or_404()
-    cornea = Cornea.query.filter(Cornea.user_id == current_user.id).order_by(
-        'datetime').all()
     language = request.cookies.get('language', 'locale')
-    condition = {}
-    if cornea:
-        k_max, thickness_min, UCVA, BSCVA, k1, k2, IS, myopia, astigmatism = [], [], [], [], [], [], [], [], []
-        stage = ''
-        for _ in cornea:
-            k_max.append(_.k_max)
-            thickness_min.append(_.thickness_min)
-            UCVA.append(_.UCVA)
-            BSCVA.append(_.BSCVA)
-            k1.append(_.k1)
-            k2.append(_.k2)
-            IS.append(abs(_.k1 - _.k2))
-            myopia.append(_.myopia)
-            astigmatism.append(_.astigmatism)
-        progress = (max(k_max) > min(k_max) + 1) and (
-                min(thickness_min) * 100 < max(thickness_min) * 98) and (
-                           max(myopia) - min(myopia) > 50)
-        if language == 'zh':
-            # China
-            if max(BSCVA) >= 1.0:
-                if max(IS) > 1.4:
-                    stage = '潜伏期'
-                else:
-                    stage = '正常'
-            elif max(BSCVA) >= 0.8:
-                if max(IS) > 1.4:
-                    stage = '初发期'
-                else:
-                    stage = '正常'
-            elif max(BSCVA) >= 0.3:
-                if min(thickness_min) > 400 and max(k_max) < 53:
-                    stage = '完成期 1 级'
-                else:
-                    stage = '初发期'
-            elif max(BSCVA) >= 0.05:
-                if min(thickness_min) > 300 and max(k_max) < 55:
-                    stage = '完成期 2 级'
-                else:
-                    stage = '完成期 1 级'
-            else:
-                if min(thickness_min) <= 300 and max(k_max) > 55:
-                    stage = '完成期 3 级'
-                else:
-                    stage = '完成期 2 级'
-        else:
-            # Foreign
-            if min(thickness_min) >= 400:
-                if max(k_max) > 48 and max(myopia) < 500 and max(astigmatism) < 500:
-                    stage = 'Early Keratoconus (Stage 1)'
-                else:
-                    stage = 'Normal'
-            elif min(thickness_min) >= 300:
-                if max(k_max) > 53:
-                    if 800 <= max(myopia) <= 1000 and 800 <= max(astigmatism) <= 1000:
-                        stage = 'Advanced Keratoconus (Stage 3)'
-                    elif 500 <= max(myopia) < 800 and 500 <= max(astigmatism) < 800:
-                        stage = 'Moderate Keratoconus (Stage 2)'
-                    else:
-                        stage = 'Early Keratoconus (Stage 1)'
-                else:
-                    stage = 'Normal'
-            else:
-                if max(k_max) > 55:
-                    stage = 'Severe Keratoconus (Stage 4)'
-                else:
-                    stage = 'Advanced Keratoconus (Stage 3)'
-        condition.update(
-            stage=stage,
-            treatment=treat(stage),
-            progress=progress
-        )
+    condition = diagnose(current_user.id, language)
     return render_template('user/profile/diagnosis.html', user=user, condition=condition)
 
 
@@ -233,12 +220,16 @@ def diagnosis(username):
 def edit_profile():
     form = EditProfileForm()
     if form.validate_on_submit():
+        admin = get_template_context()['admin']
         current_user.name = form.name.data
         current_user.username = form.username.data
         current_user.bio = form.bio.data
         current_user.website = form.website.data
         current_user.location = form.location.data
         db.session.commit()
+        # 全局模板上下文中只有管理员的名字来自个人信息
+        if admin is not None and admin.id == current_user.id and admin.name != current_user.name:
+            bump_version(TEMPLATE_CONTEXT)
         flash(_('个人信息更新成功'), 'success')
         return redirect(url_for('.index', username=current_user.username))
     form.name.data = current_user.name
@@ -249,10 +240,10 @@ def edit_profile():
     return render_template('user/settings/edit_profile.html', form=form, user=current_user)
 
 
-@user_bp.route('/settings/data/<datetime>', methods=['GET', 'POST'])
+@user_bp.route('/settings/data/<int:cornea_id>', methods=['GET', 'POST'])
 @login_required
-def change_data(datetime):
-    cornea = Cornea.query.filter(Cornea.datetime == datetime).one()
+def change_data(cornea_id):
+    cornea = Cornea.query.filter_by(id=cornea_id, user_id=current_user.id).first_or_404()
     form = ChangeDataForm()
     if form.validate_on_submit():
         cornea.datetime = form.datetime.data
@@ -263,6 +254,7 @@ def change_data(datetime):
         cornea.thickness_min = form.thickness_min.data
         cornea.BSCVA = form.BSCVA.data
         cornea.UCVA = form.UCVA.data
+        current_user.bump_cornea_version()
         db.session.commit()
         flash(_('数据更新成功'), 'success')
         return redirect(url_for('.index', username=current_user.username))
@@ -353,6 +345,8 @@ def change_email(token):
 def delete_account():
     form = DeleteAccountForm()
     if form.validate_on_submit():
+        # 注销账户会级联删除用户的图片、关注关系、发表的评论及其回复，先修正其他记录上的计数
+        current_user.release_counts()
         db.session.delete(current_user._get_current_object())
         db.session.commit()
         flash(_('注销账户成功！'), 'success')
@@ -418,123 +412,34 @@ def notification_setting():
 @user_bp.route('/<username>')
 def index(username):
     user = User.query.filter_by(username=username).first_or_404()
-    cornea = Cornea.query.filter_by(user=user).all()
-    return render_template('user/profile/charts.html', user=user, cornea=cornea)
+    return render_template('user/profile/charts.html', user=user, cornea=len(get_series(user)))
 
 
-@user_bp.route('<username>/I-S-Chart')
-@login_required
-def generate_IS_chart(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    x, y = [], []
-    for cornea in Cornea.query.filter_by(user=user).order_by('datetime').all():
-        x.append(cornea.datetime.strftime('%Y-%m-%d'))
-        y.append(round(abs(cornea.k1 - cornea.k2), 1))
-    line = Line(init_opts=opts.InitOpts(theme=ThemeType.LIGHT))
-    line.add_xaxis(x)
-    line.add_yaxis(_('角膜屈光力差值'), y)
-    line.set_global_opts(
-        title_opts=opts.TitleOpts(title=_('角膜屈光力差值变化图'),
-                                  title_textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        legend_opts=opts.LegendOpts(textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        xaxis_opts=opts.AxisOpts(axislabel_opts={'rotate': 30 if len(x) > 3 else 0}))
-    return line.dump_options_with_quotes()
-
-
-@user_bp.route('<username>/K-Chart')
-@login_required
-def generate_K_chart(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    x, y_k_max = [], []
-    for cornea in Cornea.query.filter_by(user=user).order_by('datetime').all():
-        x.append(cornea.datetime.strftime('%Y-%m-%d'))  # 转字符串
-        y_k_max.append(cornea.k_max)
-    line = Line(init_opts=opts.InitOpts(theme=ThemeType.LIGHT))
-    line.add_xaxis(x)
-    line.add_yaxis(_('最大曲率'), y_k_max)
-    line.set_global_opts(title_opts=opts.TitleOpts(title=_('最大曲率变化图'), title_textstyle_opts=opts.TextStyleOpts(
-        font_family='SimSun')),
-                         legend_opts=opts.LegendOpts(textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-                         xaxis_opts=opts.AxisOpts(axislabel_opts={'rotate': 30 if len(x) > 3 else 0}))
-    return line.dump_options_with_quotes()
-
-
-@user_bp.route('<username>/Thickness-Chart')
+# 图表数据，一次返回全部图表的配置，也可以用 chart 参数选择部分图表，max_points 参数限制每个图表的点数
+@user_bp.route('<username>/charts')
 @login_required
-def generate_thickness_chart(username):
+def charts(username):
     user = User.query.filter_by(username=username).first_or_404()
-    x, y = [], []
-    for cornea in Cornea.query.filter_by(user=user).order_by('datetime').all():
-        x.append(cornea.datetime.strftime('%Y-%m-%d'))  # 转字符串
-        y.append(cornea.thickness_min)
-    line = Line(init_opts=opts.InitOpts(theme=ThemeType.LIGHT))
-    line.add_xaxis(x)
-    line.add_yaxis(_('最薄点厚度'), y)
-    line.set_global_opts(
-        title_opts=opts.TitleOpts(title=_('最薄点厚度变化图'),
-                                  title_textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        legend_opts=opts.LegendOpts(textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        xaxis_opts=opts.AxisOpts(axislabel_opts={'rotate': 30 if len(x) > 3 else 0}))
-    return line.dump_options_with_quotes()
-
-
-@user_bp.route('<username>/VisualAcuity-Chart')
-@login_required
-def generate_visualAcuity_chart(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    x, y_1, y_2 = [], [], []
-    for cornea in Cornea.query.filter_by(user=user).order_by('datetime').all():
-        x.append(cornea.datetime.strftime('%Y-%m-%d'))  # 转字符串
-        y_1.append(cornea.BSCVA)  # 转字符串
-        y_2.append(cornea.UCVA)
-    line = Line(init_opts=opts.InitOpts(theme=ThemeType.LIGHT))
-    line.add_xaxis(x)
-    line.add_yaxis(_('最佳眼镜矫正视力'), y_1)
-    line.add_yaxis(_('裸眼视力'), y_2)
-    line.set_global_opts(
-        title_opts=opts.TitleOpts(title=_('视力变化图'),
-                                  title_textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        legend_opts=opts.LegendOpts(textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        xaxis_opts=opts.AxisOpts(axislabel_opts={'rotate': 30 if len(x) > 3 else 0}))
-    return line.dump_options_with_quotes()
-
-
-@user_bp.route('<username>/Myopia-Chart')
-@login_required
-def generate_myopia_chart(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    x, y = [], []
-    for cornea in Cornea.query.filter_by(user=user).order_by('datetime').all():
-        x.append(cornea.datetime.strftime('%Y-%m-%d'))
-        y.append(cornea.myopia)
-    line = Line(init_opts=opts.InitOpts(theme=ThemeType.LIGHT))
-    line.add_xaxis(x)
-    line.add_yaxis(_('近视度数'), y)
-    line.set_global_opts(
-        title_opts=opts.TitleOpts(title=_('近视度数变化图'),
-                                  title_textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        legend_opts=opts.LegendOpts(textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        xaxis_opts=opts.AxisOpts(axislabel_opts={'rotate': 30 if len(x) > 3 else 0}))
-    return line.dump_options_with_quotes()
-
-
-@user_bp.route('<username>/Astigmatism-Chart')
-@login_required
-def generate_astigmatism_chart(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    x, y = [], []
-    for cornea in Cornea.query.filter_by(user=user).order_by('datetime').all():
-        x.append(cornea.datetime.strftime('%Y-%m-%d'))
-        y.append(cornea.astigmatism)
-    line = Line(init_opts=opts.InitOpts(theme=ThemeType.LIGHT))
-    line.add_xaxis(x)
-    line.add_yaxis(_('散光度数'), y)
-    line.set_global_opts(
-        title_opts=opts.TitleOpts(title=_('散光度数变化图'),
-                                  title_textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        legend_opts=opts.LegendOpts(textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
-        xaxis_opts=opts.AxisOpts(axislabel_opts={'rotate': 30 if len(x) > 3 else 0}))
-    return line.dump_options_with_quotes()
+    if current_user != user and not user.public_charts:
+        abort(403)
+    names = request.args.getlist('chart')
+    if any(name not in CHARTS for name in names):
+        abort(404)
+    max_points = request.args.get('max_points', current_app.config['CK_CHART_MAX_POINTS'], type=int)
+    if max_points < 0:
+        abort(400)
+    locale = str(get_locale())
+    version = get_cornea_version(user.id)
+    etag = chart_etag(user, version, names, locale, max_points)
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(get_chart_payload(user, version, names, locale, max_points),
+                                              mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @user_bp.route('settings/history')
@@ -545,6 +450,17 @@ def history():
     return render_template('user/settings/history.html', cornea=cornea)
 
 
+# 导出当前用户的角膜数据，可用 since/until 指定检测日期范围，after 指定继续导出的位置
+@user_bp.route('settings/history/export')
+@login_required
+def export_history():
+    return export_response([current_user.id], request.args.get('format', 'csv'),
+                           since=parse_range(request.args.get('since')),
+                           until=parse_range(request.args.get('until')),
+                           after=parse_after(request.args.get('after')),
+                           filename=current_user.username)
+
+
 # 论坛管理
 
 # 文章管理
@@ -583,6 +499,7 @@ def new_post(username):
         post = Post(title=title, body=body, category=category, user=user)
         db.session.add(post)
         db.session.commit()
+        bump_version(POST_COUNTS)
         flash(_('文章发布成功'), 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     return render_template('user/forum/new_post.html', form=form)
@@ -599,10 +516,13 @@ def edit_post(username, post_id):
     form = PostForm()
     post = Post.query.get_or_404(post_id)
     if form.validate_on_submit():
+        category_id = post.category_id
         post.title = form.title.data
         post.body = form.body.data
         post.category = Category.query.get(form.category.data)
         db.session.commit()
+        if post.category_id != category_id:
+            bump_version(POST_COUNTS)
         flash(_('文章修改成功'), 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     form.title.data = post.title
@@ -620,8 +540,10 @@ def delete_post(username, post_id):
     if user != current_user:
         abort(403)
     post = Post.query.get_or_404(post_id)
+    Comment.count_unread(post.comments, -1)
     db.session.delete(post)
     db.session.commit()
+    bump_version(POST_COUNTS)
     flash(_('文章删除成功'), 'success')
     return redirect_back()
 
@@ -660,7 +582,7 @@ def manage_comment(username):
         if filter_rule == 'unread':
             # 别人给管理员的评论未读
             filtered_comments = Comment.query.join(Post).filter(
-                and_(Comment.reviewed is False, Post.user_id == user.id,
+                and_(Comment.reviewed.is_(False), Post.user_id == user.id,
                      Comment.user_id != user.id))
         elif filter_rule == 'myself':
             filtered_comments = Comment.query.filter_by(from_admin=True)
@@ -671,7 +593,7 @@ def manage_comment(username):
         if filter_rule == 'unread':
             # 别人给自己的评论未读
             filtered_comments = Comment.query.join(Post).filter(
-                and_(Comment.reviewed is False, Post.user_id == user.id,
+                and_(Comment.reviewed.is_(False), Post.user_id == user.id,
                      Comment.user_id != user.id))
         elif filter_rule == 'myself':
             # 自己写的评论
@@ -696,6 +618,7 @@ def approve_comment(username, comment_id):
     if user != current_user:
         abort(403)
     comment = Comment.query.get_or_404(comment_id)
+    Comment.count_unread([comment], -1)
     comment.reviewed = True
     db.session.commit()
     flash(_('评论已公开'), 'success')
@@ -711,6 +634,10 @@ def delete_comment(username, comment_id):
     if user != current_user:
         abort(403)
     comment = Comment.query.get_or_404(comment_id)
+    thread = list(comment.thread())
+    Comment.count_unread(thread, -1)
+    if comment.post is not None:
+        comment.post.comment_count = Post.comment_count - len(thread)
     db.session.delete(comment)
     db.session.commit()
     flash(_('评论已删除'), 'success')
@@ -725,8 +652,8 @@ def manage_collect(username):
     if user != current_user:
         abort(403)
     page = request.args.get('page', 1, type=int)
-    pagination = CollectPost.query.with_parent(user).order_by(
-        Post.timestamp.desc()).paginate(
+    pagination = CollectPost.query.with_parent(user).join(CollectPost.collected).options(
+        *loading_profile(CollectPost, 'list')).order_by(Post.timestamp.desc()).paginate(
         page, per_page=current_app.config['BLOG_MANAGE_POST_PER_PAGE'])
     posts = pagination.items
     return render_template('user/forum/manage_collect.html', user=user, page=page, pagination=pagination, posts=posts)
@@ -753,12 +680,36 @@ def manual_upload():
                         thickness_min=thickness_min, BSCVA=BSCVA, UCVA=UCVA,
                         user=current_user._get_current_object())
         db.session.add(cornea)
+        current_user.bump_cornea_version()
         db.session.commit()
         flash(_('数据上传成功'), 'success')
         return redirect(url_for('user.index', username=current_user.username))
     return render_template('user/profile/manual_upload.html', form=form)
 
 
+# 批量导入角膜数据，逐行校验并分批插入，出错的行在页面上列出
+@user_bp.route('/corneadata/import', methods=['GET', 'POST'])
+@login_required
+@confirm_required
+@permission_required('UPLOAD')
+def import_data():
+    form = ImportCorneaForm()
+    errors = []
+    if form.validate_on_submit():
+        limit = current_app.config['CK_IMPORT_ERROR_LIMIT']
+
+        def report(line, message):
+            if len(errors) < limit:
+                errors.append((line, message))
+
+        f = form.file.data
+        imported, failed = import_corneas(iter_rows(f.stream, f.filename), user_id=current_user.id,
+                                          chunk_size=current_app.config['CK_IMPORT_CHUNK_SIZE'], report=report)
+        flash(_('成功导入 %(imported)d 条数据，%(failed)d 条数据有误', imported=imported, failed=failed),
+              'success' if not failed else 'warning')
+    return render_template('user/profile/import_corneas.html', form=form, errors=errors)
+
+
 # 图片上传
 @user_bp.route('/photo-upload', methods=['GET', 'POST'])
 @login_required
@@ -781,16 +732,19 @@ def photo_upload():
         )
         db.session.add(photo)
         db.session.commit()
+        Timeline.fan_out(photo)
+        db.session.commit()
     return render_template('user/profile/photo_upload.html')
 
 
 # 删除角膜数据
-@user_bp.route('/corneadata/<datetime>/delete', methods=['POST'])
+@user_bp.route('/corneadata/<int:cornea_id>/delete', methods=['POST'])
 @login_required
 @permission_required('MANAGE')
-def delete_corneadata(datetime):
-    cornea = Cornea.query.filter(and_(Cornea.datetime == datetime, Cornea.user_id == current_user.id)).first()
+def delete_corneadata(cornea_id):
+    cornea = Cornea.query.filter_by(id=cornea_id, user_id=current_user.id).first_or_404()
     db.session.delete(cornea)
+    current_user.bump_cornea_version()
     db.session.commit()
     flash(_('数据删除成功'), 'success')
     return redirect_back()
@@ -0,0 +1,246 @@
+import bisect
+import itertools
+import random
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from flask import g, current_app
+from sqlalchemy import func
+from sqlalchemy.orm.util import identity_key
+
+from corneakeeper.charts import chart_payload
+from corneakeeper.extensions import db
+from corneakeeper.models import CacheVersion, User, Category, Link, Post, Permission, roles_permissions, Photo, \
+    loading_profile
+from corneakeeper.series import load_series
+
+TEMPLATE_CONTEXT = 'template_context'
+POST_COUNTS = 'post_counts'
+ROLE_PERMISSIONS = 'role_permissions'
+
+AdminSnapshot = namedtuple('AdminSnapshot', ['id', 'name', 'blog_title', 'blog_sub_title', 'about'])
+CategorySnapshot = namedtuple('CategorySnapshot', ['id', 'name', 'post_count'])
+LinkSnapshot = namedtuple('LinkSnapshot', ['id', 'name', 'url'])
+
+# 进程内缓存，保存快照而不是 ORM 对象，避免跨请求使用已分离的实例
+_template_context = {}
+_role_permissions = {}
+
+
+# 线程安全的 LRU 缓存，可为每个条目设置过期时间
+class LRUCache(object):
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_identities = LRUCache(maxsize=4096)
+_photo_pools = LRUCache(maxsize=2)
+_chart_payloads = LRUCache(maxsize=1024)
+_series = LRUCache(maxsize=1024)
+
+
+# 每个请求只读取一次所有版本号
+def get_versions():
+    if 'cache_versions' not in g:
+        g.cache_versions = dict(db.session.query(CacheVersion.name, CacheVersion.version).all())
+    return g.cache_versions
+
+
+def get_version(name):
+    return get_versions().get(name, 0)
+
+
+# 递增版本号，所有进程会在下一次请求时重建对应缓存
+def bump_version(name):
+    updated = CacheVersion.query.filter_by(name=name).update(
+        {CacheVersion.version: CacheVersion.version + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(CacheVersion(name=name, version=1))
+    db.session.commit()
+    g.pop('cache_versions', None)
+
+
+def build_template_context():
+    admin = User.query.first()
+    if admin is not None:
+        admin = AdminSnapshot(admin.id, admin.name, admin.blog_title, admin.blog_sub_title, admin.about)
+    categories = [CategorySnapshot(category.id, category.name, 0)
+                  for category in Category.query.order_by(Category.name).all()]
+    links = [LinkSnapshot(link.id, link.name, link.url)
+             for link in Link.query.order_by(Link.name).all()]
+    return dict(admin=admin, categories=categories, links=links)
+
+
+# 全局模板上下文，版本号未变化时直接返回缓存
+# 分类的文章数使用单独的版本号 POST_COUNTS，发布和删除文章时只重新统计文章数，不重建其余快照
+def get_template_context():
+    versions = (get_version(TEMPLATE_CONTEXT), get_version(POST_COUNTS))
+    cached = _template_context.get(TEMPLATE_CONTEXT)
+    if cached is None or cached[0] != versions:
+        context = cached[1] if cached is not None and cached[0][0] == versions[0] else build_template_context()
+        post_counts = dict(db.session.query(Post.category_id, func.count(Post.id)).group_by(Post.category_id).all())
+        context = dict(context, categories=[category._replace(post_count=post_counts.get(category.id, 0))
+                                            for category in context['categories']])
+        cached = (versions, context)
+        _template_context[TEMPLATE_CONTEXT] = cached
+    return cached[1]
+
+
+def build_role_permissions():
+    permissions = {}
+    query = db.session.query(roles_permissions.c.role_id, Permission.name).join(
+        Permission, Permission.id == roles_permissions.c.permission_id)
+    for role_id, permission_name in query.all():
+        permissions.setdefault(role_id, set()).add(permission_name)
+    return {role_id: frozenset(names) for role_id, names in permissions.items()}
+
+
+# 角色 id 到权限名集合的映射，Role.init_role 之后重新加载
+def get_role_permissions(role_id):
+    version = get_version(ROLE_PERMISSIONS)
+    cached = _role_permissions.get(ROLE_PERMISSIONS)
+    if cached is None or cached[0] != version:
+        cached = (version, build_role_permissions())
+        _role_permissions[ROLE_PERMISSIONS] = cached
+    return cached[1].get(role_id, frozenset())
+
+
+def _load_identity(user_id):
+    return User.query.options(*loading_profile(User, 'auth')).get(user_id)
+
+
+# 登录用户的身份缓存：缓存已分离的实例，每个请求只查询一次 identity_version，与缓存时的版本一致时
+# 通过 merge(load=False) 放回会话；其他进程或批量更新修改了该用户后版本号变化，缓存随之失效
+def get_identity(user_id):
+    identity_version = db.session.query(User.identity_version).filter(User.id == user_id).scalar()
+    if identity_version is None:
+        _identities.pop(user_id)
+        return None
+    version = (get_version(ROLE_PERMISSIONS), identity_version)
+    cached = _identities.get(user_id)
+    if cached is not None and cached[0] == version:
+        return db.session.merge(cached[1], load=False)
+
+    # 视图已经加载过该用户时直接复用，不能把会话中的实例分离出来缓存
+    user = db.session.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        return user
+
+    user = _load_identity(user_id)
+    if user is None:
+        _identities.pop(user_id)
+        return None
+    version = (version[0], user.identity_version)
+    db.session.expunge(user)
+    _identities.set(user_id, (version, user), ttl=current_app.config['CK_IDENTITY_CACHE_TTL'])
+    return db.session.merge(user, load=False)
+
+
+def invalidate_identity(user_id):
+    _identities.pop(user_id)
+
+
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def _invalidate_identity(mapper, connection, target):
+    invalidate_identity(target.id)
+
+
+# 图片 id 池，按收藏数加权时使用累积权重二分查找抽样
+class SamplePool(object):
+    def __init__(self, ids, weights=None):
+        self.ids = ids
+        self.cumulative = list(itertools.accumulate(weights)) if weights else None
+
+    def sample(self, count):
+        if len(self.ids) <= count:
+            return list(self.ids)
+        if self.cumulative is None:
+            return random.sample(self.ids, count)
+        total = self.cumulative[-1]
+        picked = set()
+        for _ in range(count * 10):
+            picked.add(self.ids[bisect.bisect_right(self.cumulative, random.random() * total)])
+            if len(picked) == count:
+                break
+        return list(picked)
+
+
+def build_photo_pool(weighted=False):
+    if not weighted:
+        return SamplePool([photo_id for photo_id, in db.session.query(Photo.id).all()])
+    rows = db.session.query(Photo.id, Photo.collector_count).all()
+    return SamplePool([photo_id for photo_id, _ in rows], [collects + 1 for _, collects in rows])
+
+
+# 随机抽取图片 id，id 池定期刷新，抽样开销与图片总数无关
+def sample_photo_ids(count, weighted=False):
+    pool = _photo_pools.get(weighted)
+    if pool is None:
+        pool = build_photo_pool(weighted)
+        _photo_pools.set(weighted, pool, ttl=current_app.config['CK_EXPLORE_POOL_TTL'])
+    return pool.sample(count)
+
+
+# 角膜数据版本号总是从数据库读取，用户实例可能来自身份缓存或其他进程修改前加载的会话
+def get_cornea_version(user_id):
+    return db.session.query(User.cornea_version).filter(User.id == user_id).scalar()
+
+
+# 用户的角膜数据序列，按 cornea_version 判断是否过期，图表、趋势等分析都从这里读取
+def get_series(user, version=None):
+    if version is None:
+        version = get_cornea_version(user.id)
+    cached = _series.get(user.id)
+    if cached is None or cached[0] != version:
+        cached = (version, load_series(user.id))
+        _series.set(user.id, cached)
+    return cached[1]
+
+
+def chart_etag(user, version, names, locale, max_points):
+    return '%d-%d-%s-%s-%d' % (user.id, version, locale, '.'.join(names) or 'all', max_points)
+
+
+# 图表配置按 (用户, 角膜数据版本, 语言, 图表, 点数) 缓存，数据变化后版本号递增，旧条目自然淘汰
+def get_chart_payload(user, version, names, locale, max_points):
+    key = chart_etag(user, version, names, locale, max_points)
+    payload = _chart_payloads.get(key)
+    if payload is None:
+        payload = chart_payload(get_series(user, version).columns(), names, max_points)
+        _chart_payloads.set(key, payload)
+    return payload
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from operator import itemgetter
+
+from flask_babel import lazy_gettext as _l
+from pyecharts import options as opts
+from pyecharts.charts import Line
+from pyecharts.globals import ThemeType
+
+
+def _k_difference(columns):
+    return [None if k1 is None or k2 is None else round(abs(k1 - k2), 1)
+            for k1, k2 in zip(columns['k1'], columns['k2'])]
+
+
+# 图表 id 对应 (标题, [(序列名, 从列数据取值的函数)])，顺序与页面上的图表一致
+CHARTS = OrderedDict([
+    ('VisualAcuity-Chart', (_l('视力变化图'), [(_l('最佳眼镜矫正视力'), itemgetter('BSCVA')),
+                                            (_l('裸眼视力'), itemgetter('UCVA'))])),
+    ('Thickness-Chart', (_l('最薄点厚度变化图'), [(_l('最薄点厚度'), itemgetter('thickness_min'))])),
+    ('K-Chart', (_l('最大曲率变化图'), [(_l('最大曲率'), itemgetter('k_max'))])),
+    ('I-S-Chart', (_l('角膜屈光力差值变化图'), [(_l('角膜屈光力差值'), _k_difference)])),
+    ('Myopia-Chart', (_l('近视度数变化图'), [(_l('近视度数'), itemgetter('myopia'))])),
+    ('Astigmatism-Chart', (_l('散光度数变化图'), [(_l('散光度数'), itemgetter('astigmatism'))])),
+])
+
+
+# 最小/最大值分桶降采样：把数据分成若干桶，每个序列在每个桶中保留最小值和最大值所在的点，
+# 峰值和谷值不会被丢掉，返回保留的下标（升序），点数不超过 max_points
+def downsample(series, max_points):
+    count = len(series[0]) if series else 0
+    if not max_points or count <= max_points:
+        return list(range(count))
+    buckets = max(max_points // (2 * len(series)), 1)
+    size = count / buckets
+    kept = set()
+    for bucket in range(buckets):
+        start, stop = int(bucket * size), int((bucket + 1) * size)
+        for values in series:
+            present = [i for i in range(start, stop) if values[i] is not None]
+            if present:
+                kept.add(min(present, key=values.__getitem__))
+                kept.add(max(present, key=values.__getitem__))
+    return sorted(kept)
+
+
+def build_chart(name, columns, max_points=None):
+    title, series = CHARTS[name]
+    values = [(label, get(columns)) for label, get in series]
+    indexes = downsample([data for _, data in values], max_points)
+    x = [columns['date'][i] for i in indexes]
+    line = Line(init_opts=opts.InitOpts(theme=ThemeType.LIGHT))
+    line.add_xaxis(x)
+    for label, data in values:
+        line.add_yaxis(str(label), [data[i] for i in indexes])
+    line.set_global_opts(
+        title_opts=opts.TitleOpts(title=str(title),
+                                  title_textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
+        legend_opts=opts.LegendOpts(textstyle_opts=opts.TextStyleOpts(font_family='SimSun')),
+        xaxis_opts=opts.AxisOpts(axislabel_opts={'rotate': 30 if len(x) > 3 else 0}))
+    return line.dump_options_with_quotes()
+
+
+# 多个图表的配置合并为一个 JSON 对象，键为图表 id；max_points 为每个图表最多的点数，0 表示不降采样
+def chart_payload(columns, names=None, max_points=None):
+    names = names or list(CHARTS)
+    return '{%s}' % ', '.join('"%s": %s' % (name, build_chart(name, columns, max_points)) for name in names)
@@ -0,0 +1,107 @@
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from flask import Response, stream_with_context, abort
+from sqlalchemy import and_, or_
+
+from corneakeeper.extensions import db
+from corneakeeper.models import Cornea, User
+
+# 与导入的列名一致，导出的文件可以直接再导入；最后的 user_id 和 id 两列用于继续导出，导入时忽略
+EXPORT_COLUMNS = ('username', 'datetime', 'updatetime', 'k1', 'k2', 'k_max', 'thickness_min', 'BSCVA', 'UCVA',
+                  'myopia', 'astigmatism', 'user_id', 'id')
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+# 解析 since/until 参数，格式为 ISO 日期或日期时间
+def parse_range(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+# 解析继续导出的位置 "user_id,检测日期,id"，即已收到的最后一行的 user_id、datetime、id 三列，格式错误时抛出 ValueError
+def parse_position(value):
+    if not value:
+        return None
+    user_id, when, cornea_id = value.split(',')
+    return int(user_id), datetime.fromisoformat(when.strip()), int(cornea_id)
+
+
+def parse_after(value):
+    try:
+        return parse_position(value)
+    except ValueError:
+        abort(400)
+
+
+# 按 (用户, 检测日期, id) 顺序逐行读取，使用服务端游标，内存占用与行数无关
+# since 包含在内，until 不包含，只按检测日期过滤；中断后把已收到的最后一行的位置作为 after 继续导出，
+# 只返回排在该位置之后的行，不会遗漏或重复
+def iter_corneas(user_ids=None, since=None, until=None, after=None, batch_size=1000):
+    query = db.session.query(User.username, *[getattr(Cornea, name) for name in EXPORT_COLUMNS[1:]]).join(
+        User, User.id == Cornea.user_id)
+    if user_ids is not None:
+        query = query.filter(Cornea.user_id.in_(user_ids))
+    if since is not None:
+        query = query.filter(Cornea.datetime >= since)
+    if until is not None:
+        query = query.filter(Cornea.datetime < until)
+    if after is not None:
+        user_id, when, cornea_id = after
+        query = query.filter(and_(Cornea.user_id >= user_id, or_(
+            Cornea.user_id > user_id, Cornea.datetime > when, and_(Cornea.datetime == when, Cornea.id > cornea_id))))
+    query = query.order_by(Cornea.user_id, Cornea.datetime, Cornea.id)
+    return query.execution_options(stream_results=True).yield_per(batch_size)
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def generate_csv(rows, batch_size=1000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow([_json_value(value) for value in row])
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def generate_ndjson(rows, batch_size=1000):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(EXPORT_COLUMNS, map(_json_value, row))), ensure_ascii=False))
+        if len(lines) >= batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def generate(rows, export_format):
+    return generate_csv(rows) if export_format == 'csv' else generate_ndjson(rows)
+
+
+# 以流式响应导出角膜数据，format 为 csv 或 ndjson
+def export_response(user_ids, export_format, since=None, until=None, after=None, filename='cornea'):
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    rows = iter_corneas(user_ids, since, until, after)
+    response = Response(stream_with_context(generate(rows, export_format)), mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (filename, export_format)
+    return response
@@ -27,9 +27,8 @@ babel = Babel()
 #  用户加载函数
 @login_manager.user_loader
 def load_user(user_id):
-    from corneakeeper.models import User
-    user = User.query.get(int(user_id))
-    return user
+    from corneakeeper.caches import get_identity
+    return get_identity(int(user_id))
 
 
 class Guest(AnonymousUserMixin):
@@ -117,6 +117,9 @@ def fake_comments(count=20):
         db.session.add(comment)
     db.session.commit()
 
+    User.reconcile_counts()
+    Post.reconcile_counts()
+
     # for i in range(User.query.count()):
     #     # replies
     #     for j in range(count):
@@ -162,3 +165,18 @@ def fake_corneas(count=10):
             )
             db.session.add(cornea)
         db.session.commit()
+
+
+# 批量生成文章，用于分页等性能测试
+def fake_bulk_posts(count=100000, chunk_size=5000):
+    category_ids = [category.id for category in Category.query.all()] or [None]
+    user_ids = [user.id for user in User.query.all()] or [None]
+    for start in range(0, count, chunk_size):
+        db.session.bulk_insert_mappings(Post, [dict(
+            title=fake.sentence(),
+            body=fake.sentence(),
+            category_id=random.choice(category_ids),
+            user_id=random.choice(user_ids),
+            timestamp=fake.date_time_this_decade()
+        ) for _ in range(min(chunk_size, count - start))])
+        db.session.commit()
@@ -2,8 +2,8 @@ from flask_login import current_user
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed, FileRequired
 from flask_babel import lazy_gettext as _l
-from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField, HiddenField, \
-    ValidationError, DateTimeField, FloatField, IntegerField
+from wtforms import Form, StringField, PasswordField, SubmitField, BooleanField, TextAreaField, HiddenField, \
+    ValidationError, DateTimeField, FloatField, IntegerField, FieldList, FormField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, Optional, Regexp, NumberRange
 
 from corneakeeper.models import User
@@ -37,6 +37,37 @@ class ChangeDataForm(FlaskForm):
     submit = SubmitField(_l('提交'))
 
 
+# 批量识别结果中的一行，取值范围与 ChangeDataForm 一致，只校验勾选确认的行
+class RecognizedCorneaForm(Form):
+    photo_id = HiddenField()
+    confirm = BooleanField(_l('确认'))
+    datetime = DateTimeField(_l('检测日期'), validators=[DataRequired()])
+    k1 = FloatField('k1', validators=[DataRequired(), NumberRange(0, 100)])
+    k2 = FloatField('k2', validators=[DataRequired(), NumberRange(0, 100)])
+    k_max = FloatField(_l('最大曲率'), validators=[DataRequired(), NumberRange(0, 100)])
+    thickness_min = IntegerField(_l('最薄点厚度'), validators=[DataRequired(), NumberRange(0, 700)])
+    BSCVA = FloatField(_l('最佳眼镜矫正视力'), validators=[DataRequired(), NumberRange(0, 1.5)])
+    UCVA = FloatField(_l('裸眼视力'), validators=[Optional(), NumberRange(0, 1.5)])
+
+    def validate(self, extra_validators=None):
+        if not self.confirm.data:
+            return True
+        return super(RecognizedCorneaForm, self).validate(extra_validators)
+
+
+class BatchRecognitionForm(FlaskForm):
+    rows = FieldList(FormField(RecognizedCorneaForm))
+    submit = SubmitField(_l('保存勾选的数据'))
+
+
+class ImportCorneaForm(FlaskForm):
+    file = FileField(_l('数据文件'), validators=[
+        FileRequired(),
+        FileAllowed(['csv', 'xlsx'], _l('文件后缀名为.csv或者.xlsx'))
+    ])
+    submit = SubmitField(_l('导入'))
+
+
 class UploadAvatarForm(FlaskForm):
     image = FileField(_l('上传'), validators=[
         FileRequired(),
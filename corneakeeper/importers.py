@@ -0,0 +1,151 @@
+import csv
+import io
+from datetime import datetime
+
+from corneakeeper.caches import invalidate_identity
+from corneakeeper.extensions import db
+from corneakeeper.models import Cornea, CorneaAggregate, CorneaTrend, User
+
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d')
+
+
+class RowError(ValueError):
+    pass
+
+
+def _parse_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise RowError('invalid date "%s"' % value)
+
+
+def _number(kind, low, high):
+    def parse(value):
+        try:
+            number = kind(float(value)) if kind is int else kind(value)
+        except (TypeError, ValueError):
+            raise RowError('not a number "%s"' % value)
+        if not low <= number <= high:
+            raise RowError('%s out of range %s-%s' % (number, low, high))
+        return number
+    return parse
+
+
+# 列名 -> (解析函数, 是否必填)，取值范围与 ChangeDataForm 一致
+IMPORT_FIELDS = (
+    ('datetime', _parse_datetime, True),
+    ('updatetime', _parse_datetime, False),
+    ('k1', _number(float, 0, 100), True),
+    ('k2', _number(float, 0, 100), True),
+    ('k_max', _number(float, 0, 100), True),
+    ('thickness_min', _number(int, 0, 700), True),
+    ('BSCVA', _number(float, 0, 1.5), True),
+    ('UCVA', _number(float, 0, 1.5), False),
+    ('myopia', _number(int, 0, 10000), False),
+    ('astigmatism', _number(int, 0, 10000), False),
+)
+
+
+def parse_row(row):
+    values = {}
+    for name, parse, required in IMPORT_FIELDS:
+        value = row.get(name)
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == '':
+            if required:
+                raise RowError('%s is required' % name)
+            values[name] = None
+            continue
+        try:
+            values[name] = parse(value)
+        except RowError as e:
+            raise RowError('%s: %s' % (name, e))
+    values['updatetime'] = values['updatetime'] or datetime.now()
+    return values
+
+
+# 逐行读取 CSV，stream 为二进制文件对象
+def iter_csv_rows(stream):
+    yield from csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+
+
+# 以只读模式逐行读取第一个工作表，第一行为列名
+def iter_xlsx_rows(stream):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(name).strip() if name is not None else '' for name in next(rows, ())]
+        for values in rows:
+            yield dict(zip(header, values))
+    finally:
+        workbook.close()
+
+
+def iter_rows(stream, filename):
+    if filename.lower().endswith('.xlsx'):
+        return iter_xlsx_rows(stream)
+    return iter_csv_rows(stream)
+
+
+# 导入完成后重算涉及用户的汇总数据和趋势并使图表缓存和登录身份缓存失效，批量插入不会触发 Cornea 的 flush 事件
+def _refresh_users(user_ids):
+    user_ids = sorted(user_ids)
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        for user_id in chunk:
+            CorneaAggregate.recompute(user_id)
+            CorneaTrend.recompute(user_id)
+        User.query.filter(User.id.in_(chunk)).update(
+            {User.cornea_version: User.cornea_version + 1, User.identity_version: User.identity_version + 1},
+            synchronize_session=False)
+        db.session.commit()
+        for user_id in chunk:
+            invalidate_identity(user_id)
+
+
+# 流式导入角膜数据：逐行校验，每 chunk_size 行批量插入并提交一次，内存占用与文件大小无关
+# 指定 user_id 时所有数据都属于该用户，否则按每行的 username 列查找用户
+# 出错的行调用 report(行号, 错误信息)，返回 (导入行数, 出错行数)
+def import_corneas(rows, user_id=None, chunk_size=1000, report=None):
+    user_ids, affected = {}, set()
+    chunk, imported, failed = [], 0, 0
+
+    for line, row in enumerate(rows, start=2):
+        try:
+            values = parse_row(row)
+            owner_id = user_id
+            if owner_id is None:
+                username = (row.get('username') or '').strip()
+                if username not in user_ids:
+                    user_ids[username] = db.session.query(User.id).filter_by(username=username).scalar()
+                owner_id = user_ids[username]
+                if owner_id is None:
+                    raise RowError('unknown username "%s"' % username)
+        except RowError as e:
+            failed += 1
+            if report is not None:
+                report(line, str(e))
+            continue
+        values['user_id'] = owner_id
+        affected.add(owner_id)
+        chunk.append(values)
+        if len(chunk) >= chunk_size:
+            db.session.bulk_insert_mappings(Cornea, chunk)
+            db.session.commit()
+            imported += len(chunk)
+            chunk = []
+
+    if chunk:
+        db.session.bulk_insert_mappings(Cornea, chunk)
+        db.session.commit()
+        imported += len(chunk)
+    _refresh_users(affected)
+    return imported, failed
@@ -1,10 +1,29 @@
-from datetime import datetime
+import json
+import math
+from datetime import datetime, date
+from functools import partial
 from flask import current_app
 from flask_login import UserMixin
 from flask_avatars import Identicon
+from sqlalchemy import func, or_
+from sqlalchemy.orm import joinedload, selectinload, raiseload, defer
 from corneakeeper.extensions import db, whooshee
 from werkzeug.security import generate_password_hash, check_password_hash
 
+
+# 用关联子查询批量修正计数字段，只更新与实际数量不一致的行，返回修正的行数
+# 批量更新不经过 flush，修正用户的计数时同时递增 identity_version，使缓存的登录身份失效
+def reconcile(column, count_query):
+    counts = count_query.as_scalar()
+    values = {column: counts}
+    if column.class_ is User:
+        values[User.identity_version] = User.identity_version + 1
+    updated = column.class_.query.filter(or_(column.is_(None), column != counts)).update(
+        values, synchronize_session=False)
+    db.session.commit()
+    return updated
+
+
 # relationship table
 roles_permissions = db.Table('roles_permissions',
                              db.Column('role_id', db.Integer,
@@ -53,6 +72,9 @@ class Role(db.Model):
                 role.permissions.append(permission)
         db.session.commit()
 
+        from corneakeeper.caches import bump_version, ROLE_PERMISSIONS
+        bump_version(ROLE_PERMISSIONS)
+
 
 # relationship object
 class Follow(db.Model):
@@ -61,10 +83,12 @@ class Follow(db.Model):
     followed_id = db.Column(db.Integer, db.ForeignKey('user.id'),
                             primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # 回填截止时间：被关注者不晚于该时间的图片没有全部写入时间线，由 Timeline.feed_sources 从图片表读取；为空表示已全部写入
+    backfill_until = db.Column(db.DateTime)
     follower = db.relationship('User', foreign_keys=[follower_id],
-                               back_populates='following', lazy='joined')
+                               back_populates='following')
     followed = db.relationship('User', foreign_keys=[followed_id],
-                               back_populates='followers', lazy='joined')
+                               back_populates='followers')
 
 
 @whooshee.register_model('username', 'name')
@@ -107,6 +131,12 @@ class User(UserMixin, db.Model):
     avatar_l = db.Column(db.String(64))
     avatar_raw = db.Column(db.String(64))
 
+    unread_comments = db.Column(db.Integer, default=0, nullable=False)  # 未审核的评论数
+    follower_count = db.Column(db.Integer, default=0, nullable=False)  # 粉丝数
+    following_count = db.Column(db.Integer, default=0, nullable=False)  # 关注数
+    cornea_version = db.Column(db.Integer, default=0, nullable=False)  # 角膜数据版本号，用于图表缓存
+    identity_version = db.Column(db.Integer, default=0, nullable=False)  # 用户行每次修改时递增，用于校验登录身份缓存
+
     cornea = db.relationship('Cornea',
                              back_populates='user')  # 与 cornea 建立一对多关系
     comments = db.relationship('Comment', back_populates='user',
@@ -120,11 +150,9 @@ class User(UserMixin, db.Model):
     notifications = db.relationship('Notification', back_populates='receiver',
                                     cascade='all')  # 建立用户和通知的一对多关系
     photo_collections = db.relationship('CollectPhoto',
-                                        back_populates='collector',
-                                        lazy='joined')
+                                        back_populates='collector')
     post_collections = db.relationship('CollectPost',
-                                       back_populates='collector',
-                                       lazy='joined')
+                                       back_populates='collector')
     following = db.relationship('Follow', foreign_keys=[Follow.follower_id],
                                 back_populates='follower',
                                 lazy='dynamic', cascade='all')
@@ -152,6 +180,10 @@ class User(UserMixin, db.Model):
                 self.role = Role.query.filter_by(name='User').first()
             db.session.commit()
 
+    # 角膜数据增删改后调用，使该用户的图表缓存失效
+    def bump_cornea_version(self):
+        self.cornea_version = User.cornea_version + 1
+
     @property
     def is_admin(self):
         return self.role.name == 'Admin'
@@ -160,6 +192,7 @@ class User(UserMixin, db.Model):
         if not self.is_collecting_post(post):
             collect = CollectPost(collector=self, collected=post)
             db.session.add(collect)
+            post.collector_count = Post.collector_count + 1
             db.session.commit()
 
     def uncollect_post(self, post):
@@ -167,6 +200,7 @@ class User(UserMixin, db.Model):
             collected_id=post.id).first()
         if collect:
             db.session.delete(collect)
+            post.collector_count = Post.collector_count - 1
             db.session.commit()
 
     def is_collecting_post(self, post):
@@ -177,6 +211,7 @@ class User(UserMixin, db.Model):
         if not self.is_collecting_photo(photo):
             collect = CollectPhoto(collector=self, collected=photo)
             db.session.add(collect)
+            photo.collector_count = Photo.collector_count + 1
             db.session.commit()
 
     def uncollect_photo(self, photo):
@@ -184,6 +219,7 @@ class User(UserMixin, db.Model):
             collected_id=photo.id).first()
         if collect:
             db.session.delete(collect)
+            photo.collector_count = Photo.collector_count - 1
             db.session.commit()
 
     def is_collecting_photo(self, photo):
@@ -194,12 +230,18 @@ class User(UserMixin, db.Model):
         if not self.is_following(user):
             follow = Follow(follower=self, followed=user)
             db.session.add(follow)
+            Timeline.backfill(follow)
+            self.following_count = User.following_count + 1
+            user.follower_count = User.follower_count + 1
             db.session.commit()
 
     def unfollow(self, user):
         follow = self.following.filter_by(followed_id=user.id).first()
         if follow:
             db.session.delete(follow)
+            Timeline.prune(self, user)
+            self.following_count = User.following_count - 1
+            user.follower_count = User.follower_count - 1
             db.session.commit()
 
     def is_following(self, user):
@@ -212,8 +254,59 @@ class User(UserMixin, db.Model):
 
     # 验证当前用户权限
     def can(self, permission_name):
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission is not None and self.role is not None and permission in self.role.permissions
+        from corneakeeper.caches import get_role_permissions
+        return self.role_id is not None and permission_name in get_role_permissions(self.role_id)
+
+    # 批量修正计数字段，返回每个字段修正的行数
+    @staticmethod
+    def reconcile_counts():
+        return dict(
+            follower_count=reconcile(User.follower_count, db.session.query(func.count(Follow.follower_id)).filter(
+                Follow.followed_id == User.id)),
+            following_count=reconcile(User.following_count, db.session.query(func.count(Follow.followed_id)).filter(
+                Follow.follower_id == User.id)),
+            unread_comments=reconcile(User.unread_comments, db.session.query(func.count(Comment.id)).join(
+                Post, Comment.post_id == Post.id).filter(Comment.reviewed.is_(False), Post.user_id == User.id))
+        )
+
+    # 注销账户前修正其他记录上的计数字段，与删除用户在同一事务中提交：关注的用户的粉丝数和粉丝的关注数，
+    # 评论所在图片和文章的评论数及文章作者的未审核评论数，收藏的图片和文章的收藏数，图片所属标签的图片数
+    # 用户的收藏记录和别人对用户图片的收藏记录不会级联删除，在这里一并删除
+    def release_counts(self):
+        for column, user_ids in ((User.follower_count, db.session.query(Follow.followed_id).filter(
+                Follow.follower_id == self.id)), (User.following_count, db.session.query(Follow.follower_id).filter(
+                Follow.followed_id == self.id))):
+            User.query.filter(User.id.in_(user_ids.subquery())).update(
+                {column: column - 1, User.identity_version: User.identity_version + 1}, synchronize_session=False)
+
+        comments = set(reply for comment in self.comments for reply in comment.thread())
+        Comment.count_unread(comments, -1)
+        comment_ids = [comment.id for comment in comments]
+        for model, column in ((Photo, Comment.photo_id), (Post, Comment.post_id)):
+            if not comment_ids:
+                break
+            removed = db.session.query(func.count(Comment.id)).filter(
+                Comment.id.in_(comment_ids), column == model.id).as_scalar()
+            model.query.filter(model.id.in_(db.session.query(column).filter(Comment.id.in_(comment_ids)).subquery())) \
+                .update({model.comment_count: model.comment_count - removed}, synchronize_session=False)
+
+        photo_ids = db.session.query(Photo.id).filter(Photo.user_id == self.id)
+        removed = db.session.query(func.count()).select_from(tagging).filter(
+            tagging.c.tag_id == Tag.id, tagging.c.photo_id.in_(photo_ids.subquery())).as_scalar()
+        Tag.query.filter(Tag.id.in_(db.session.query(tagging.c.tag_id).filter(
+            tagging.c.photo_id.in_(photo_ids.subquery())).subquery())).update(
+            {Tag.photo_count: Tag.photo_count - removed}, synchronize_session=False)
+
+        for model, link in ((Photo, CollectPhoto), (Post, CollectPost)):
+            model.query.filter(model.id.in_(db.session.query(link.collected_id).filter(
+                link.collector_id == self.id).subquery())).update(
+                {model.collector_count: model.collector_count - 1}, synchronize_session=False)
+        Photo.sync_tagging(db.session.query(CollectPhoto.collected_id).filter(
+            CollectPhoto.collector_id == self.id).subquery())
+        CollectPhoto.query.filter(or_(CollectPhoto.collector_id == self.id, CollectPhoto.collected_id.in_(
+            photo_ids.subquery()))).delete(synchronize_session=False)
+        CollectPost.query.filter_by(collector_id=self.id).delete(synchronize_session=False)
+        db.session.expire(self, ['photo_collections', 'post_collections'])
 
     # 生成头像文件
     def generate_avatar(self):
@@ -225,9 +318,13 @@ class User(UserMixin, db.Model):
         db.session.commit()
 
 
+# collector_count 为图片收藏数的副本，标签页按收藏数排序时只扫描 ix_tagging_tag_collects，不需要排序整个标签的图片
 tagging = db.Table('tagging',
                    db.Column('photo_id', db.Integer, db.ForeignKey('photo.id')),
-                   db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'))
+                   db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
+                   db.Column('collector_count', db.Integer, default=0, nullable=False),
+                   db.Index('ix_tagging_tag_photo', 'tag_id', 'photo_id'),
+                   db.Index('ix_tagging_tag_collects', 'tag_id', 'collector_count', 'photo_id')
                    )
 
 
@@ -238,10 +335,8 @@ class CollectPost(db.Model):
     collected_id = db.Column(db.Integer, db.ForeignKey('post.id'),
                              primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow())
-    collector = db.relationship('User', back_populates='post_collections',
-                                lazy='joined')
-    collected = db.relationship('Post', back_populates='collectors',
-                                lazy='joined')
+    collector = db.relationship('User', back_populates='post_collections')
+    collected = db.relationship('Post', back_populates='collectors')
 
 
 # 建立用户和照片模型的多对多关系
@@ -253,10 +348,8 @@ class CollectPhoto(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
     # 通过 CollectPhoto 模型建立 User 和 Photo 的多对多关系
-    collector = db.relationship('User', back_populates='photo_collections',
-                                lazy='joined')
-    collected = db.relationship('Photo', back_populates='collectors',
-                                lazy='joined')
+    collector = db.relationship('User', back_populates='photo_collections')
+    collected = db.relationship('Photo', back_populates='collectors')
 
 
 @whooshee.register_model('description')
@@ -266,19 +359,135 @@ class Photo(db.Model):
     filename = db.Column(db.String(64))
     filename_s = db.Column(db.String(64))
     filename_m = db.Column(db.String(64))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     can_comment = db.Column(db.Boolean, default=True)  # 是否可以评论
+    fanned_out = db.Column(db.Boolean, default=False, nullable=False)  # 上传时是否已写入粉丝的时间线
 
     # 建立用户和照片的一对多关系
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship('User', back_populates='photos')
 
-    collectors = db.relationship('CollectPhoto', back_populates='collected',
-                                 lazy='joined')
+    collectors = db.relationship('CollectPhoto', back_populates='collected')
+    collector_count = db.Column(db.Integer, default=0, nullable=False)  # 收藏数
+    comment_count = db.Column(db.Integer, default=0, nullable=False)  # 评论数
     tags = db.relationship('Tag', secondary=tagging, back_populates='photos')
     comments = db.relationship('Comment', back_populates='photo',
                                cascade='all')  # 建立图片和 comment 的一对多关系
 
+    # 游标分页、按收藏数排序和时间线读扩散使用的复合索引
+    __table_args__ = (db.Index('ix_photo_user_timestamp', 'user_id', 'timestamp', 'id'),
+                      db.Index('ix_photo_collector_count', 'collector_count', 'id'),
+                      db.Index('ix_photo_user_fanned_out', 'user_id', 'fanned_out', 'timestamp', 'id'))
+
+    @staticmethod
+    def reconcile_counts():
+        counts = dict(
+            collector_count=reconcile(Photo.collector_count, db.session.query(
+                func.count(CollectPhoto.collector_id)).filter(CollectPhoto.collected_id == Photo.id)),
+            comment_count=reconcile(Photo.comment_count, db.session.query(func.count(Comment.id)).filter(
+                Comment.photo_id == Photo.id))
+        )
+        counts['tagging_collector_count'] = Photo.sync_tagging()
+        db.session.commit()
+        return counts
+
+    # 把收藏数复制到 tagging 表，photo_ids 为 None 时同步所有图片，返回修改的行数
+    @staticmethod
+    def sync_tagging(photo_ids=None):
+        counts = db.session.query(Photo.collector_count).filter(Photo.id == tagging.c.photo_id).as_scalar()
+        statement = tagging.update().where(tagging.c.collector_count != counts).values(collector_count=counts)
+        if photo_ids is not None:
+            statement = statement.where(tagging.c.photo_id.in_(photo_ids))
+        return db.session.execute(statement).rowcount
+
+
+# 关注动态时间线：上传图片时写入每个粉丝的时间线（写扩散），粉丝过多的用户改为读取时合并（读扩散）
+# 每张图片使用哪种方式在上传时决定并记录在 Photo.fanned_out 上，之后粉丝数变化不影响已上传的图片
+class Timeline(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id', ondelete='CASCADE'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index('ix_timeline_user_timestamp', 'user_id', 'timestamp', 'photo_id'),)
+
+    @staticmethod
+    def is_fan_out_on_read(user):
+        return user.follower_count > current_app.config['CK_TIMELINE_FANOUT_LIMIT']
+
+    @staticmethod
+    def fan_out(photo):
+        photo.fanned_out = not Timeline.is_fan_out_on_read(photo.user)
+        if not photo.fanned_out:
+            return
+        follower_ids = db.session.query(Follow.follower_id).filter(Follow.followed_id == photo.user_id).all()
+        db.session.bulk_insert_mappings(Timeline, [
+            dict(user_id=follower_id, photo_id=photo.id, author_id=photo.user_id, timestamp=photo.timestamp)
+            for follower_id, in follower_ids])
+
+    # 回填被关注者最近的 CK_TIMELINE_BACKFILL 张图片，更早的图片记下截止时间，翻页时从图片表读取
+    @staticmethod
+    def backfill(follow):
+        limit = current_app.config['CK_TIMELINE_BACKFILL']
+        photos = db.session.query(Photo.id, Photo.timestamp).filter(
+            Photo.user_id == follow.followed.id, Photo.fanned_out.is_(True)).order_by(
+            Photo.timestamp.desc(), Photo.id.desc()).limit(limit + 1).all()
+        follow.backfill_until = photos[limit][1] if len(photos) > limit else None
+        db.session.bulk_insert_mappings(Timeline, [
+            dict(user_id=follow.follower.id, photo_id=photo_id, author_id=follow.followed.id, timestamp=timestamp)
+            for photo_id, timestamp in photos[:limit]])
+
+    @staticmethod
+    def prune(user, followed):
+        Timeline.query.filter_by(user_id=user.id, author_id=followed.id).delete(synchronize_session=False)
+
+    @staticmethod
+    def remove_photo(photo):
+        Timeline.query.filter_by(photo_id=photo.id).delete(synchronize_session=False)
+
+    # 时间线的分页来源：物化的时间线，关注的用户中未写入时间线的图片，以及超出回填数量的更早的图片
+    # 与回填截止时间相同的图片可能已在时间线中，由 merge_keyset_paginate 按 id 去重
+    @staticmethod
+    def feed_sources(user):
+        photos = Photo.query.options(*loading_profile(Photo, 'list'))
+        sources = [(photos.join(Timeline, Timeline.photo_id == Photo.id).filter(Timeline.user_id == user.id),
+                    Timeline.timestamp, Timeline.photo_id)]
+        unfanned = db.session.query(Photo.id).filter(Photo.user_id == Follow.followed_id, Photo.fanned_out.is_(False))
+        author_ids = [followed_id for followed_id, in db.session.query(Follow.followed_id).filter(
+            Follow.follower_id == user.id, unfanned.exists()).all()]
+        if author_ids:
+            sources.append((photos.filter(Photo.user_id.in_(author_ids), Photo.fanned_out.is_(False)),
+                            Photo.timestamp, Photo.id))
+        truncated = Follow.query.filter(Follow.follower_id == user.id, Follow.backfill_until.isnot(None))
+        if db.session.query(truncated.exists()).scalar():
+            sources.append((photos.join(Follow, Follow.followed_id == Photo.user_id).filter(
+                Follow.follower_id == user.id, Photo.fanned_out.is_(True),
+                Photo.timestamp <= Follow.backfill_until), Photo.timestamp, Photo.id))
+        return sources
+
+    # 根据关注关系重建所有时间线，按当前粉丝数重新决定每个用户的图片使用哪种方式
+    # 每个被关注者的图片按时间编号，用一条 INSERT ... SELECT 写入前 CK_TIMELINE_BACKFILL 张，
+    # 第 CK_TIMELINE_BACKFILL + 1 张的时间作为回填截止时间；窗口函数需要 MySQL 8.0 或 SQLite 3.25 以上
+    @staticmethod
+    def rebuild():
+        limit = current_app.config['CK_TIMELINE_BACKFILL']
+        Timeline.query.delete(synchronize_session=False)
+        fan_out_ids = db.session.query(User.id).filter(
+            User.follower_count <= current_app.config['CK_TIMELINE_FANOUT_LIMIT'])
+        Photo.query.update({Photo.fanned_out: Photo.user_id.in_(fan_out_ids.subquery())},
+                           synchronize_session=False)
+        ranked = db.session.query(Photo.id, Photo.user_id, Photo.timestamp, func.row_number().over(
+            partition_by=Photo.user_id, order_by=(Photo.timestamp.desc(), Photo.id.desc())).label('rank')).filter(
+            Photo.fanned_out.is_(True)).subquery()
+        rows = db.session.query(Follow.follower_id, ranked.c.id, ranked.c.user_id, ranked.c.timestamp).join(
+            ranked, ranked.c.user_id == Follow.followed_id).filter(ranked.c.rank <= limit)
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'photo_id', 'author_id', 'timestamp'], rows.statement))
+        backfill_until = db.session.query(ranked.c.timestamp).filter(
+            ranked.c.user_id == Follow.followed_id, ranked.c.rank == limit + 1)
+        Follow.query.update({Follow.backfill_until: backfill_until.as_scalar()}, synchronize_session=False)
+        db.session.commit()
+
 
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -312,12 +521,25 @@ class Post(db.Model):
     #  建立用户和文章的一对多关系
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship('User', back_populates='posts')
-    collectors = db.relationship('CollectPost', back_populates='collected',
-                                 lazy='joined')
+    collectors = db.relationship('CollectPost', back_populates='collected')
+    collector_count = db.Column(db.Integer, default=0, nullable=False)  # 收藏数
+    comment_count = db.Column(db.Integer, default=0, nullable=False)  # 评论数
     category = db.relationship('Category', back_populates='posts')
     comments = db.relationship('Comment', back_populates='post',
                                cascade='all, delete-orphan')
 
+    # 游标分页使用的复合索引
+    __table_args__ = (db.Index('ix_post_category_timestamp', 'category_id', 'timestamp', 'id'),)
+
+    @staticmethod
+    def reconcile_counts():
+        return dict(
+            collector_count=reconcile(Post.collector_count, db.session.query(
+                func.count(CollectPost.collector_id)).filter(CollectPost.collected_id == Post.id)),
+            comment_count=reconcile(Post.comment_count, db.session.query(func.count(Comment.id)).filter(
+                Comment.post_id == Post.id))
+        )
+
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -344,6 +566,33 @@ class Comment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship('User', back_populates='comments')  # 建立用户和评论的一对多关系
 
+    # 评论及其所有回复，删除评论时回复会被级联删除
+    def thread(self):
+        yield self
+        for reply in self.replies:
+            for comment in reply.thread():
+                yield comment
+
+    # 修正文章作者的未审核评论数：新增未审核的评论时 delta 为 1，审核或删除时为 -1
+    # 已审核的评论和图片评论不计入，同一条评论只计一次，正在删除的作者不再修改
+    @staticmethod
+    def count_unread(comments, delta):
+        counts, seen = {}, set()
+        for comment in comments:
+            if comment.reviewed or comment.post is None or comment.post.user is None or comment in seen:
+                continue
+            seen.add(comment)
+            counts[comment.post.user] = counts.get(comment.post.user, 0) + delta
+        for user, count in counts.items():
+            if user not in db.session.deleted:
+                user.unread_comments = User.unread_comments + count
+
+
+# 缓存版本号，数据变更时递增以使进程内缓存失效
+class CacheVersion(db.Model):
+    name = db.Column(db.String(30), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
 
 class Link(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -366,6 +615,358 @@ class Cornea(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 定义外键
     user = db.relationship('User', back_populates='cornea')  # 与 User 建立一对多关系
 
+    # 历史记录、图表和导出都按用户过滤并按检测日期排序
+    __table_args__ = (db.Index('ix_cornea_user_datetime', 'user_id', 'datetime', 'id'),)
+
+
+# 每个用户角膜数据的汇总指标，诊断时直接读取，Cornea 增删改时在同一事务中增量维护
+class CorneaAggregate(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    cornea_count = db.Column(db.Integer, default=0, nullable=False)
+    k_max_max = db.Column(db.Float)
+    k_max_min = db.Column(db.Float)
+    thickness_min = db.Column(db.Integer)
+    thickness_max = db.Column(db.Integer)
+    myopia_max = db.Column(db.Integer)
+    myopia_min = db.Column(db.Integer)
+    astigmatism_max = db.Column(db.Integer)
+    BSCVA_max = db.Column(db.DECIMAL(2, 1))
+    IS_max = db.Column(db.Float)  # max(|k1 - k2|)
+
+    # (汇总字段, 来源指标, 取最大值还是最小值)
+    FIELDS = (('k_max_max', 'k_max', 'max'), ('k_max_min', 'k_max', 'min'),
+              ('thickness_min', 'thickness_min', 'min'), ('thickness_max', 'thickness_min', 'max'),
+              ('myopia_max', 'myopia', 'max'), ('myopia_min', 'myopia', 'min'),
+              ('astigmatism_max', 'astigmatism', 'max'), ('BSCVA_max', 'BSCVA', 'max'), ('IS_max', 'IS', 'max'))
+
+    # 从一条角膜数据取出汇总用到的指标，get 为按属性名取值的函数
+    @staticmethod
+    def measures(get):
+        k1, k2 = get('k1'), get('k2')
+        return dict(datetime=get('datetime'), k_max=get('k_max'), thickness_min=get('thickness_min'),
+                    myopia=get('myopia'), astigmatism=get('astigmatism'), BSCVA=get('BSCVA'),
+                    IS=None if k1 is None or k2 is None else abs(k1 - k2))
+
+    def add(self, measures):
+        self.cornea_count = (self.cornea_count or 0) + 1
+        for field, source, kind in CorneaAggregate.FIELDS:
+            value, current = measures[source], getattr(self, field)
+            if value is not None:
+                setattr(self, field, value if current is None else (max if kind == 'max' else min)(current, value))
+
+    # 移除一条数据，返回 False 表示移除的是某项极值，需要完整重算
+    def remove(self, measures):
+        self.cornea_count = (self.cornea_count or 0) - 1
+        if self.cornea_count <= 0:
+            return False
+        for field, source, kind in CorneaAggregate.FIELDS:
+            value, current = measures[source], getattr(self, field)
+            if value is not None and (current is None or math.isclose(value, current, rel_tol=1e-6) or (
+                    value > current if kind == 'max' else value < current)):
+                return False
+        return True
+
+    @staticmethod
+    def _query():
+        sources = dict(k_max=Cornea.k_max, thickness_min=Cornea.thickness_min, myopia=Cornea.myopia,
+                       astigmatism=Cornea.astigmatism, BSCVA=Cornea.BSCVA, IS=func.abs(Cornea.k1 - Cornea.k2))
+        return db.session.query(Cornea.user_id, func.count(Cornea.id), *[
+            getattr(func, kind)(sources[source]) for _, source, kind in CorneaAggregate.FIELDS])
+
+    # 从角膜数据完整重算一个用户的汇总，没有数据时删除汇总行
+    @staticmethod
+    def recompute(user_id, aggregate=None):
+        row = CorneaAggregate._query().filter(Cornea.user_id == user_id).group_by(Cornea.user_id).first()
+        aggregate = aggregate or CorneaAggregate.query.get(user_id)
+        if row is None:
+            if aggregate is not None and db.inspect(aggregate).persistent:
+                db.session.delete(aggregate)
+            elif aggregate is not None:
+                db.session.expunge(aggregate)
+            return None
+        if aggregate is None:
+            aggregate = CorneaAggregate(user_id=user_id)
+            db.session.add(aggregate)
+        aggregate.cornea_count = row[1]
+        for (field, _, _), value in zip(CorneaAggregate.FIELDS, row[2:]):
+            setattr(aggregate, field, value)
+        return aggregate
+
+    # 根据全部角膜数据重建汇总表
+    @staticmethod
+    def rebuild():
+        CorneaAggregate.query.delete(synchronize_session=False)
+        for row in CorneaAggregate._query().filter(Cornea.user_id.isnot(None)).group_by(Cornea.user_id).all():
+            aggregate = CorneaAggregate(user_id=row[0], cornea_count=row[1])
+            for (field, _, _), value in zip(CorneaAggregate.FIELDS, row[2:]):
+                setattr(aggregate, field, value)
+            db.session.add(aggregate)
+        db.session.commit()
+
+
+# 每个用户主要指标的变化趋势：按时间指数衰减加权的最小二乘斜率，越早的数据权重越低
+# 每个指标保存加权和 [条数, Σw, Σwx, Σwy, Σwxx, Σwxy]，x 为相对 last_day 的天数
+# 加入、删除一条数据都只需常数时间，不用重新读取历史数据
+class CorneaTrend(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    last_day = db.Column(db.Integer)  # 加权和的参考日期，1970-01-01 起的天数
+    sums = db.Column(db.Text)  # JSON，指标名 -> 加权和
+    k_max_slope = db.Column(db.Float)  # 每年的变化量
+    thickness_slope = db.Column(db.Float)
+    myopia_slope = db.Column(db.Float)
+    progressing = db.Column(db.Boolean, default=False, nullable=False, index=True)
+
+    METRICS = (('k_max', 'k_max_slope'), ('thickness_min', 'thickness_slope'), ('myopia', 'myopia_slope'))
+    HALF_LIFE = 365  # 权重减半的天数
+
+    @staticmethod
+    def day(value):
+        return (value.date() - date(1970, 1, 1)).days
+
+    # 解析后的加权和，refresh 写回 sums 之前的修改都在这个字典上进行
+    def _sums(self):
+        if getattr(self, '_cached_sums', None) is None:
+            self._cached_sums = json.loads(self.sums) if self.sums else dict(
+                (metric, [0] * 6) for metric, _ in CorneaTrend.METRICS)
+        return self._cached_sums
+
+    # 参考日期移到 day，已有的权重按经过的天数衰减，x 随之平移
+    def _advance(self, day):
+        if self.last_day is None:
+            self.last_day = day
+            return
+        shift = day - self.last_day
+        decay = 0.5 ** (shift / CorneaTrend.HALF_LIFE)
+        for values in self._sums().values():
+            count, n, x, y, xx, xy = values
+            n, x, y, xx, xy = n * decay, x * decay, y * decay, xx * decay, xy * decay
+            values[1:] = [n, x - shift * n, y, xx - 2 * shift * x + shift * shift * n, xy - shift * y]
+        self.last_day = day
+
+    def _update(self, day, measures, sign):
+        if sign > 0 and (self.last_day is None or day > self.last_day):
+            self._advance(day)
+        x = day - self.last_day
+        weight = sign * 0.5 ** (-x / CorneaTrend.HALF_LIFE)
+        for metric, values in self._sums().items():
+            y = measures[metric]
+            if y is None or y != y:  # 数据序列中的缺失值为 nan
+                continue
+            y = float(y)
+            values[0] += sign
+            if values[0] <= 0:
+                values[:] = [0] * 6
+                continue
+            for i, term in enumerate((1, x, y, x * x, x * y), start=1):
+                values[i] += weight * term
+
+    def add(self, measures):
+        if measures['datetime'] is not None:
+            self._update(CorneaTrend.day(measures['datetime']), measures, 1)
+
+    def remove(self, measures):
+        if measures['datetime'] is not None:
+            self._update(CorneaTrend.day(measures['datetime']), measures, -1)
+
+    # 由加权和计算每年的斜率，并判断病情是否在进展，阈值与 staging.progress 一致
+    def refresh(self):
+        sums = self._sums()
+        for metric, field in CorneaTrend.METRICS:
+            count, n, x, y, xx, xy = sums[metric]
+            spread = n * xx - x * x
+            slope = None
+            if count >= 2 and spread > 1e-9 * n * n:
+                slope = (n * xy - x * y) / spread * 365
+            setattr(self, field, slope)
+        thickness = sums['thickness_min']
+        self.progressing = bool(
+            self.k_max_slope is not None and self.k_max_slope > 1 and
+            self.thickness_slope is not None and self.thickness_slope * 100 < -2 * thickness[3] / thickness[1] and
+            self.myopia_slope is not None and self.myopia_slope > 50)
+        self.sums = json.dumps(sums)
+        self._cached_sums = None
+
+    # 由按检测日期排序的数据序列（series.CorneaSeries）计算趋势
+    @staticmethod
+    def _from_series(user_id, series, trend=None):
+        trend = trend or CorneaTrend(user_id=user_id)
+        trend.last_day, trend.sums, trend._cached_sums = None, None, None
+        columns = [(metric, series.column(metric).tolist()) for metric, _ in CorneaTrend.METRICS]
+        for i, day in enumerate(series.arrays['day'].tolist()):
+            trend._update(day, dict((metric, values[i]) for metric, values in columns), 1)
+        trend.refresh()
+        return trend
+
+    # 从角膜数据序列完整重算一个用户的趋势，没有数据时删除趋势行
+    # 直接读取数据库而不是 caches.get_series，调用时本次事务的修改还没有反映到 cornea_version 上
+    @staticmethod
+    def recompute(user_id, trend=None):
+        from corneakeeper.series import load_series
+
+        series = load_series(user_id)
+        trend = trend or CorneaTrend.query.get(user_id)
+        if not len(series):
+            if trend is not None and db.inspect(trend).persistent:
+                db.session.delete(trend)
+            elif trend is not None:
+                db.session.expunge(trend)
+            return None
+        if trend is None:
+            trend = CorneaTrend(user_id=user_id)
+            db.session.add(trend)
+        return CorneaTrend._from_series(user_id, series, trend)
+
+    # 根据全部角膜数据重建趋势表，一次查询按用户逐个流式读取数据序列
+    @staticmethod
+    def rebuild():
+        from corneakeeper.series import iter_series
+
+        CorneaTrend.query.delete()
+        for user_id, series in iter_series():
+            db.session.add(CorneaTrend._from_series(user_id, series))
+        db.session.commit()
+
+
+def _old_measures(cornea):
+    state = db.inspect(cornea)
+
+    def get(name):
+        history = state.attrs[name].history
+        if history.deleted:
+            return history.deleted[0]
+        if history.added:
+            raise LookupError(name)  # 修改前的值没有加载过
+        return getattr(cornea, name)
+
+    try:
+        return get('user_id'), CorneaAggregate.measures(get)
+    except LookupError:
+        return get('user_id'), None
+
+
+# 用户有任何列被修改时递增 identity_version，各进程缓存的登录身份据此判断是否过期
+# 批量 update() 不经过 flush，需要自行递增
+@db.event.listens_for(db.session, 'before_flush')
+def _bump_identity_versions(session, flush_context, instances):
+    for user in session.dirty:
+        if isinstance(user, User) and session.is_modified(user, include_collections=False):
+            user.identity_version = User.identity_version + 1
+
+
+# 收藏数或标签变化的图片在 flush 之后把收藏数同步到 tagging 表
+@db.event.listens_for(db.session, 'before_flush')
+def _collect_tagging_changes(session, flush_context, instances):
+    photos = session.info.setdefault('tagging_photos', set())
+    for photo in session.new:
+        if isinstance(photo, Photo) and photo.tags and photo.collector_count:
+            photos.add(photo)
+    for photo in session.dirty:
+        if isinstance(photo, Photo):
+            state = db.inspect(photo)
+            if state.attrs.collector_count.history.has_changes() or state.attrs.tags.history.added:
+                photos.add(photo)
+
+
+@db.event.listens_for(db.session, 'after_flush_postexec')
+def _apply_tagging_changes(session, flush_context):
+    photos = session.info.pop('tagging_photos', None)
+    if photos:
+        Photo.sync_tagging([photo.id for photo in photos])
+
+
+# 记录本次 flush 中角膜数据的变化，flush 完成后再更新汇总，此时新数据的 user_id 已经确定
+@db.event.listens_for(db.session, 'before_flush')
+def _collect_cornea_changes(session, flush_context, instances):
+    changes = session.info.setdefault('cornea_changes', [])
+    for cornea in session.new:
+        if isinstance(cornea, Cornea):
+            changes.append(('add', cornea, CorneaAggregate.measures(partial(getattr, cornea))))
+    for cornea in session.dirty:
+        if isinstance(cornea, Cornea) and session.is_modified(cornea):
+            changes.append(('remove',) + _old_measures(cornea))
+            changes.append(('add', cornea, CorneaAggregate.measures(partial(getattr, cornea))))
+    for cornea in session.deleted:
+        if isinstance(cornea, Cornea):
+            changes.append(('remove',) + _old_measures(cornea))
+
+
+def _apply_aggregate_changes(session, changes):
+    aggregates, stale = {}, set()
+
+    def aggregate_of(user_id):
+        if user_id not in aggregates:
+            aggregates[user_id] = CorneaAggregate.query.get(user_id)
+        return aggregates[user_id]
+
+    for action, target, measures in changes:
+        user_id = target.user_id if action == 'add' else target
+        if user_id is None or user_id in stale:
+            continue
+        aggregate = aggregate_of(user_id)
+        if action == 'add':
+            if aggregate is None:
+                aggregate = aggregates[user_id] = CorneaAggregate(user_id=user_id)
+                session.add(aggregate)
+            aggregate.add(measures)
+        elif aggregate is None or measures is None or not aggregate.remove(measures):
+            stale.add(user_id)
+    for user_id in stale:
+        CorneaAggregate.recompute(user_id, aggregates.get(user_id))
+
+
+def _apply_trend_changes(session, changes):
+    trends, stale = {}, set()
+    for action, target, measures in changes:
+        user_id = target.user_id if action == 'add' else target
+        if user_id is None or user_id in stale:
+            continue
+        if user_id not in trends:
+            trends[user_id] = CorneaTrend.query.get(user_id)
+        trend = trends[user_id]
+        if action == 'add':
+            if trend is None:
+                trend = trends[user_id] = CorneaTrend(user_id=user_id)
+                session.add(trend)
+            trend.add(measures)
+        elif trend is None or measures is None:
+            stale.add(user_id)
+        else:
+            trend.remove(measures)
+    for user_id, trend in trends.items():
+        if user_id in stale:
+            CorneaTrend.recompute(user_id, trend)
+        elif trend is not None:
+            trend.refresh()
+
+
+@db.event.listens_for(db.session, 'after_flush_postexec')
+def _apply_cornea_changes(session, flush_context):
+    changes = session.info.pop('cornea_changes', None)
+    if not changes:
+        return
+    _apply_aggregate_changes(session, changes)
+    _apply_trend_changes(session, changes)
+
+
+# 图片识别结果，按图片内容的 SHA-256 保存，同一张图片只调用一次识别服务
+class OcrResult(db.Model):
+    digest = db.Column(db.String(64), primary_key=True)
+    words_result = db.Column(db.Text, nullable=False)  # 识别服务返回的 words_result，JSON
+    fields = db.Column(db.Text, nullable=False)  # post_processing 解析出的数据，JSON
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# 后台识别任务，状态为 pending、running、done 或 failed，结果按 digest 保存在 OcrResult 中
+class OcrJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), index=True, nullable=False)
+    status = db.Column(db.String(16), default='pending', nullable=False)
+    error = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    finished = db.Column(db.DateTime)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id', ondelete='SET NULL'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))
+
 
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -382,4 +983,37 @@ class Notification(db.Model):
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True)
+    photo_count = db.Column(db.Integer, default=0, nullable=False, index=True)  # 标签下的图片数，用于热门标签排序
     photos = db.relationship('Photo', secondary=tagging, back_populates='tags')
+
+    @staticmethod
+    def reconcile_counts():
+        return dict(
+            photo_count=reconcile(Tag.photo_count, db.session.query(func.count(tagging.c.photo_id)).filter(
+                tagging.c.tag_id == Tag.id))
+        )
+
+
+# 按视图选用的关系加载方案：list 用于列表页，detail 用于详情页，auth 用于加载登录用户（除 about 外的所有列和角色）
+# 模型上的关系默认都是按需加载，页面需要的关系在这里预先加载，列表页用不到的集合直接禁止加载
+LOADING_PROFILES = {
+    'list': {
+        Photo: (joinedload(Photo.user), raiseload(Photo.collectors),
+                raiseload(Photo.comments), raiseload(Photo.tags)),
+        Post: (joinedload(Post.category), raiseload(Post.collectors), raiseload(Post.comments)),
+        CollectPhoto: (joinedload(CollectPhoto.collector), joinedload(CollectPhoto.collected)),
+        CollectPost: (joinedload(CollectPost.collector), joinedload(CollectPost.collected).joinedload(Post.category)),
+        Follow: (joinedload(Follow.follower), joinedload(Follow.followed)),
+    },
+    'detail': {
+        Photo: (joinedload(Photo.user), selectinload(Photo.tags), raiseload(Photo.collectors)),
+        Post: (joinedload(Post.user), joinedload(Post.category), raiseload(Post.collectors)),
+    },
+    'auth': {
+        User: (joinedload(User.role), defer(User.about)),
+    },
+}
+
+
+def loading_profile(model, name):
+    return LOADING_PROFILES[name][model]
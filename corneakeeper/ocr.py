@@ -0,0 +1,217 @@
+import abc
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from corneakeeper.extensions import db
+from corneakeeper.models import OcrResult, OcrJob
+from corneakeeper.utils import post_processing
+
+
+class OcrError(Exception):
+    pass
+
+
+# 批量识别中的一张图片：key 为调用方给的标识（如图片 id），内容与前面某张相同时 duplicate_of 为那张的 key，
+# 其余字段只对第一次出现的图片有值；fields 为解析出的数据，job 为后台任务，error 为出错信息
+BatchItem = namedtuple('BatchItem', ['key', 'digest', 'fields', 'job', 'error', 'duplicate_of'])
+
+
+def image_digest(image):
+    return hashlib.sha256(image).hexdigest()
+
+
+# 识别服务接口：recognize 接收图片内容，返回与百度通用文字识别相同格式的字典，
+# 成功时包含 words_result，失败时包含 error_code 和 error_msg
+class OcrBackend(abc.ABC):
+    @abc.abstractmethod
+    def recognize(self, image):
+        pass
+
+
+class BaiduBackend(OcrBackend):
+    def __init__(self, config):
+        from aip import AipOcr
+
+        self.client = AipOcr(config['CK_BAIDU_APP_ID'], config['CK_BAIDU_API_KEY'], config['CK_BAIDU_SECRET_KEY'])
+
+    def recognize(self, image):
+        return self.client.basicGeneral(image)
+
+
+# 本地替身，回放记录下来的 words_result，不需要网络和调用额度，用于压测和基准测试
+# 延迟服从对数正态分布，中位数为 CK_OCR_FAKE_LATENCY 秒；按 CK_OCR_FAKE_ERROR_RATE 的比例返回错误
+# 同一张图片总是得到同一份记录
+class FakeBackend(OcrBackend):
+    def __init__(self, config):
+        with open(config['CK_OCR_FAKE_FIXTURES'], encoding='utf-8') as f:
+            self.fixtures = [fixture['words_result'] for fixture in json.load(f)]
+        self.latency = config['CK_OCR_FAKE_LATENCY']
+        self.sigma = config['CK_OCR_FAKE_LATENCY_SIGMA']
+        self.error_rate = config['CK_OCR_FAKE_ERROR_RATE']
+        self.random = random.Random(config['CK_OCR_FAKE_SEED'])
+
+    def recognize(self, image):
+        if self.latency:
+            time.sleep(self.random.lognormvariate(math.log(self.latency), self.sigma))
+        if self.random.random() < self.error_rate:
+            return dict(error_code=18, error_msg='Open api qps request limit reached')
+        words_result = self.fixtures[int(image_digest(image), 16) % len(self.fixtures)]
+        return dict(words_result=words_result, words_result_num=len(words_result))
+
+
+OCR_BACKENDS = {'baidu': BaiduBackend, 'fake': FakeBackend}
+
+
+# 按 CK_OCR_BACKEND 创建识别服务，每个应用只创建一次
+def get_backend():
+    backend = current_app.extensions.get('ocr_backend')
+    if backend is None:
+        backend = OCR_BACKENDS[current_app.config['CK_OCR_BACKEND']](current_app.config)
+        current_app.extensions['ocr_backend'] = backend
+    return backend
+
+
+def cached_fields(digest):
+    cached = OcrResult.query.get(digest)
+    return json.loads(cached.fields) if cached is not None else None
+
+
+# 识别图片并保存结果，返回 (words_result, 解析出的数据)；内容相同的图片直接读取保存的结果
+# 识别服务返回错误时抛出 OcrError，错误结果不保存
+def recognize(image):
+    digest = image_digest(image)
+    cached = OcrResult.query.get(digest)
+    if cached is not None:
+        return json.loads(cached.words_result), json.loads(cached.fields)
+
+    result = get_backend().recognize(image)
+    if 'words_result' not in result:
+        raise OcrError(result.get('error_msg', 'unknown error'))
+    fields = post_processing(result)
+    db.session.add(OcrResult(digest=digest, words_result=json.dumps(result['words_result'], ensure_ascii=False),
+                             fields=json.dumps(fields)))
+    try:
+        db.session.commit()
+    except IntegrityError:  # 同一张图片被同时识别，保留先保存的结果
+        db.session.rollback()
+    return result['words_result'], fields
+
+
+# 进程内的识别线程池，信号量限制排队和进行中的任务数
+_pool = None
+_slots = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(app):
+    global _pool, _slots
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=app.config['CK_OCR_WORKERS'], thread_name_prefix='ocr')
+            _slots = threading.BoundedSemaphore(app.config['CK_OCR_QUEUE_SIZE'])
+    return _pool, _slots
+
+
+def _run_job(app, job_id, image):
+    with app.app_context():
+        job = OcrJob.query.get(job_id)
+        job.status = 'running'
+        db.session.commit()
+        try:
+            recognize(image)
+        except Exception as e:  # 后台线程中的任何错误都记录到任务上，由轮询接口返回
+            db.session.rollback()
+            job.status, job.error = 'failed', str(e) or e.__class__.__name__
+        else:
+            job.status = 'done'
+        job.finished = datetime.utcnow()
+        db.session.commit()
+
+
+# 提交后台识别任务，返回 (解析出的数据, 任务)：已有识别结果时直接返回数据，任务为 None；
+# 同一张图片有未完成的任务时复用该任务；队列已满时抛出 OcrError
+def submit(image, photo_id=None, user_id=None):
+    digest = image_digest(image)
+    fields = cached_fields(digest)
+    if fields is not None:
+        return fields, None
+
+    since = datetime.utcnow() - timedelta(seconds=current_app.config['CK_OCR_JOB_TIMEOUT'])
+    # 只复用同一用户的任务，查询任务状态时会校验任务属于当前用户
+    job = OcrJob.query.filter(OcrJob.digest == digest, OcrJob.user_id == user_id,
+                              OcrJob.status.in_(('pending', 'running')), OcrJob.timestamp > since).first()
+    if job is not None:
+        return None, job
+
+    pool, slots = _get_pool(current_app)
+    if not slots.acquire(blocking=False):
+        raise OcrError('too many recognition jobs, please try again later')
+    try:
+        job = OcrJob(digest=digest, photo_id=photo_id, user_id=user_id)
+        db.session.add(job)
+        db.session.commit()
+        future = pool.submit(_run_job, current_app._get_current_object(), job.id, image)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return None, job
+
+
+# 逐张提交后台识别任务，内容相同的图片只提交一次；队列已满的图片记录错误，其余照常提交
+def submit_many(images, user_id=None):
+    items, first = [], {}
+    for key, image in images:
+        digest = image_digest(image)
+        if digest in first:
+            items.append(BatchItem(key, digest, None, None, None, first[digest]))
+            continue
+        first[digest] = key
+        try:
+            fields, job = submit(image, key, user_id)
+        except OcrError as e:
+            items.append(BatchItem(key, digest, None, None, str(e), None))
+            continue
+        items.append(BatchItem(key, digest, fields, job, None, None))
+    return items
+
+
+def _recognize_in_context(app, image):
+    with app.app_context():
+        try:
+            return recognize(image)[1], None
+        except Exception as e:
+            return None, str(e) or e.__class__.__name__
+
+
+# 同步批量识别，最多 workers 张同时识别，内容相同或已有识别结果的图片不再调用识别服务
+def recognize_many(images, workers):
+    images, unique = list(images), OrderedDict()
+    digests = [image_digest(image) for _, image in images]
+    for (key, image), digest in zip(images, digests):
+        unique.setdefault(digest, (key, image))
+    results = dict((row.digest, (json.loads(row.fields), None)) for row in OcrResult.query.filter(
+        OcrResult.digest.in_(list(unique))).all())
+    missing = [digest for digest in unique if digest not in results]
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results.update(zip(missing, pool.map(lambda digest: _recognize_in_context(app, unique[digest][1]), missing)))
+
+    items = []
+    for (key, _), digest in zip(images, digests):
+        first_key = unique[digest][0]
+        if first_key != key:
+            items.append(BatchItem(key, digest, None, None, None, first_key))
+        else:
+            items.append(BatchItem(key, digest, results[digest][0], None, results[digest][1], None))
+    return items
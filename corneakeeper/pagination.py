@@ -0,0 +1,107 @@
+from datetime import datetime
+
+from flask import current_app, abort
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_, DateTime
+
+
+# 游标分页结果，接口与 Flask-SQLAlchemy 的 Pagination 保持相近
+class KeysetPagination(object):
+    cursor_mode = True
+
+    def __init__(self, items, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='cursor')
+
+
+# 游标中保存排序列的值和 id，时间类型的排序列以 ISO 格式保存
+def encode_cursor(direction, item, column=None):
+    value = getattr(item, column.key if column is not None else 'timestamp')
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return _serializer().dumps([direction, value, item.id])
+
+
+def decode_cursor(cursor, column=None):
+    try:
+        direction, value, item_id = _serializer().loads(cursor)
+        if column is None or isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        else:
+            value = int(value)
+        return direction, value, int(item_id)
+    except (BadSignature, ValueError, TypeError):
+        abort(400)
+
+
+def _keyset_rows(query, column, item_id, key, direction, limit):
+    if direction == 'prev':
+        if key is not None:
+            query = query.filter(and_(column >= key[0], or_(column > key[0], item_id > key[1])))
+        return query.order_by(column.asc(), item_id.asc()).limit(limit).all()
+    if key is not None:
+        query = query.filter(and_(column <= key[0], or_(column < key[0], item_id < key[1])))
+    return query.order_by(column.desc(), item_id.desc()).limit(limit).all()
+
+
+# 合并多个来源的游标分页，sources 为 (query, 排序列, id 列) 列表，各来源按同一游标分别做范围扫描后归并
+# 各来源的排序列需要同名，游标取返回对象上的同名属性
+def merge_keyset_paginate(sources, cursor=None, per_page=20):
+    column = sources[0][1]
+    direction, key = 'next', None
+    if cursor:
+        direction, value, item_id = decode_cursor(cursor, column)
+        key = (value, item_id)
+
+    rows, seen = [], set()
+    for query, sort_column, item_id in sources:
+        for row in _keyset_rows(query, sort_column, item_id, key, direction, per_page + 1):
+            if row.id not in seen:
+                seen.add(row.id)
+                rows.append(row)
+    rows.sort(key=lambda row: (getattr(row, column.key), row.id), reverse=direction != 'prev')
+
+    if direction == 'prev':
+        has_prev, has_next = len(rows) > per_page, key is not None
+        items = rows[:per_page][::-1]
+    else:
+        has_prev, has_next = key is not None, len(rows) > per_page
+        items = rows[:per_page]
+
+    if not items:
+        return KeysetPagination(items)
+    return KeysetPagination(
+        items,
+        prev_cursor=encode_cursor('prev', items[0], column) if has_prev else None,
+        next_cursor=encode_cursor('next', items[-1], column) if has_next else None)
+
+
+# 按 (排序列, id) 倒序的游标分页，排序列默认为 timestamp，每页只做一次索引范围扫描，不需要 OFFSET 和 COUNT
+# 排序列来自关联表时 item_id 传关联表上的 id 列，使排序能使用关联表的复合索引
+def keyset_paginate(query, model, cursor=None, per_page=20, column=None, item_id=None):
+    column = column if column is not None else model.timestamp
+    item_id = item_id if item_id is not None else model.id
+    return merge_keyset_paginate([(query, column, item_id)], cursor, per_page)
+
+
+# 配置开启或请求中带有 cursor 参数时使用游标分页，否则保持原有的页码分页
+def paginate(query, model, page, per_page, cursor=None, column=None, item_id=None):
+    if cursor is not None or current_app.config['CK_CURSOR_PAGINATION']:
+        return keyset_paginate(query, model, cursor, per_page, column, item_id)
+    if column is None:
+        return query.order_by(model.timestamp.desc()).paginate(page, per_page)
+    item_id = item_id if item_id is not None else model.id
+    return query.order_by(column.desc(), item_id.desc()).paginate(page, per_page)
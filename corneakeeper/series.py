@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+
+from corneakeeper.extensions import db
+from corneakeeper.models import Cornea
+
+# 列名 -> 数组类型；检测日期保存为 1970-01-01 起的天数，整数列用 MISSING 表示缺失，浮点列用 nan
+SERIES_DTYPES = OrderedDict([
+    ('day', np.int32),
+    ('k1', np.float32),
+    ('k2', np.float32),
+    ('k_max', np.float32),
+    ('thickness_min', np.int16),
+    ('BSCVA', np.float32),
+    ('UCVA', np.float32),
+    ('myopia', np.int16),
+    ('astigmatism', np.int16),
+])
+MISSING = -1
+DECIMALS = 4  # float32 转回 Python 数值时保留的小数位数，去掉单精度带来的尾数
+
+
+# 单个用户按检测日期排序的角膜数据，每列一个定长数组，每行约 26 字节
+class CorneaSeries(object):
+    __slots__ = ('arrays',)
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays['day'])
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    # 返回 float64 数组，缺失值为 nan，用于数值计算
+    def column(self, name):
+        array = self.arrays[name]
+        if array.dtype.kind == 'f':
+            return array.astype(np.float64).round(DECIMALS)
+        values = array.astype(np.float64)
+        values[array == MISSING] = np.nan
+        return values
+
+    # 返回 Python 列表，缺失值为 None，用于生成图表
+    def values(self, name):
+        array = self.arrays[name]
+        if array.dtype.kind == 'f':
+            return [None if value != value else value for value in self.column(name).tolist()]
+        return [None if value == MISSING else value for value in array.tolist()]
+
+    def dates(self):
+        return np.datetime_as_string(self.arrays['day'].astype('datetime64[D]')).tolist()
+
+    # 按列名返回列表，另加 date 列为横轴使用的日期字符串
+    def columns(self):
+        columns = dict((name, self.values(name)) for name in SERIES_DTYPES if name != 'day')
+        columns['date'] = self.dates()
+        return columns
+
+
+def _array(values, dtype):
+    if np.dtype(dtype).kind == 'f':
+        return np.array([np.nan if value is None else value for value in values], dtype=dtype)
+    return np.array([MISSING if value is None else value for value in values], dtype=dtype)
+
+
+def _query_column(name):
+    column = getattr(Cornea, name)
+    if isinstance(column.type, db.DECIMAL):
+        return db.cast(column, db.Float)
+    return column
+
+
+def _columns():
+    return [db.func.date(Cornea.datetime)] + [_query_column(name) for name in list(SERIES_DTYPES)[1:]]
+
+
+def _build(rows):
+    values = list(zip(*rows)) if rows else [()] * len(SERIES_DTYPES)
+    arrays = dict((name, _array(column, dtype))
+                  for (name, dtype), column in zip(list(SERIES_DTYPES.items())[1:], values[1:]))
+    arrays['day'] = np.array([str(value) for value in values[0]], dtype='datetime64[D]').astype(np.int32)
+    return CorneaSeries(arrays)
+
+
+# 一次只查询需要的列，不创建 ORM 对象，视力列在数据库中转为浮点数，不经过 Decimal
+def load_series(user_id):
+    rows = db.session.query(*_columns()).filter(Cornea.user_id == user_id, Cornea.datetime.isnot(None)).order_by(
+        Cornea.datetime).all()
+    return _build(rows)
+
+
+# 按用户依次返回 (用户 id, 数据序列)，一次查询流式读取全部用户，用于重建趋势等批量计算
+def iter_series(batch_size=1000):
+    rows = db.session.query(Cornea.user_id, *_columns()).filter(
+        Cornea.user_id.isnot(None), Cornea.datetime.isnot(None)).order_by(
+        Cornea.user_id, Cornea.datetime).yield_per(batch_size)
+    for user_id, user_rows in groupby(rows, key=itemgetter(0)):
+        yield user_id, _build([row[1:] for row in user_rows])
@@ -48,6 +48,17 @@ class BaseConfig(object):
     #  图片展示设置
     CK_PHOTO_PER_PAGE = 12
     CK_USER_PER_PAGE = 20
+    CK_CURSOR_PAGINATION = False  # 使用游标分页代替页码分页
+    CK_TIMELINE_FANOUT_LIMIT = 5000  # 粉丝数超过该值的用户不写入粉丝时间线，改为读取时合并
+    CK_TIMELINE_BACKFILL = 200  # 关注用户时回填的图片数，更早的图片翻页时从图片表读取
+    CK_EXPLORE_POOL_TTL = 300  # 发现页图片 id 池的刷新间隔（秒）
+    CK_EXPLORE_BY_COLLECTS = False  # 发现页按收藏数加权抽样
+
+    #  登录用户身份缓存时间（秒）
+    CK_IDENTITY_CACHE_TTL = 30
+
+    #  图表设置
+    CK_CHART_MAX_POINTS = 300  # 每个图表最多显示的点数，超过时降采样
 
     #  图片上传设置
     CK_UPLOAD_PATH = os.path.join(basedir, 'uploads')  # 图片上传路径
@@ -57,6 +68,25 @@ class BaseConfig(object):
         CK_PHOTO_SIZE['medium']: '_m',  # display
     }  # 图片后缀
 
+    #  图片识别设置
+    CK_OCR_WORKERS = 4  # 后台识别线程数
+    CK_OCR_QUEUE_SIZE = 32  # 排队和进行中的识别任务上限，超过时拒绝新任务
+    CK_OCR_JOB_TIMEOUT = 300  # 超过该时间（秒）仍未完成的任务视为失败，可以重新提交
+    CK_OCR_BACKEND = os.getenv('CK_OCR_BACKEND', 'baidu')  # 识别服务，baidu 或 fake（本地回放，用于压测）
+    CK_BAIDU_APP_ID = os.getenv('APP_ID')  # 百度文字识别的应用凭据
+    CK_BAIDU_API_KEY = os.getenv('API_KEY')
+    CK_BAIDU_SECRET_KEY = os.getenv('BAIDU_SECRET_KEY')
+    CK_OCR_FAKE_FIXTURES = os.path.join(basedir, 'corneakeeper', 'fixtures', 'ocr_results.json')
+    CK_OCR_FAKE_LATENCY = 0.5  # 本地回放的延迟中位数（秒）
+    CK_OCR_FAKE_LATENCY_SIGMA = 0.5  # 延迟对数正态分布的 sigma，越大长尾越明显
+    CK_OCR_FAKE_ERROR_RATE = 0.0  # 本地回放返回错误的比例
+    CK_OCR_FAKE_SEED = None
+
+    #  角膜数据批量导入设置
+    CK_IMPORT_CHUNK_SIZE = 1000  # 每批插入的行数
+    CK_IMPORT_MAX_SIZE = 200 * 1024 * 1024  # 导入文件大小上限，不受 MAX_CONTENT_LENGTH 限制
+    CK_IMPORT_ERROR_LIMIT = 100  # 页面上显示的出错行数
+
     # DROPZONE 配置
     DROPZONE_MAX_FILE_SIZE = 3
     DROPZONE_MAX_FILES = 30
@@ -0,0 +1,97 @@
+from collections import namedtuple
+
+import numpy as np
+
+from corneakeeper.extensions import db
+from corneakeeper.models import CorneaAggregate, CorneaTrend
+from corneakeeper.utils import treat
+
+# 分期规则用到的每个用户的汇总指标，各字段为按用户对齐的数组
+Aggregates = namedtuple('Aggregates', ['k_max_max', 'k_max_min', 'thickness_min', 'thickness_max', 'myopia_max',
+                                       'myopia_min', 'astigmatism_max', 'BSCVA_max', 'IS_max'])
+
+ZH_STAGES = ('潜伏期', '正常', '初发期', '正常', '完成期 1 级', '初发期', '完成期 2 级', '完成期 1 级', '完成期 3 级')
+FOREIGN_STAGES = ('Early Keratoconus (Stage 1)', 'Normal', 'Advanced Keratoconus (Stage 3)',
+                  'Moderate Keratoconus (Stage 2)', 'Early Keratoconus (Stage 1)', 'Normal',
+                  'Severe Keratoconus (Stage 4)')
+
+
+def stage_zh(agg):
+    bscva, is_max = agg.BSCVA_max, agg.IS_max
+    thickness, k_max = agg.thickness_min, agg.k_max_max
+    conditions = [
+        (bscva >= 1.0) & (is_max > 1.4),
+        bscva >= 1.0,
+        (bscva >= 0.8) & (is_max > 1.4),
+        bscva >= 0.8,
+        (bscva >= 0.3) & (thickness > 400) & (k_max < 53),
+        bscva >= 0.3,
+        (bscva >= 0.05) & (thickness > 300) & (k_max < 55),
+        bscva >= 0.05,
+        (thickness <= 300) & (k_max > 55),
+    ]
+    return np.select(conditions, np.array(ZH_STAGES, dtype=object), default='完成期 2 级')
+
+
+def stage_foreign(agg):
+    thickness, k_max = agg.thickness_min, agg.k_max_max
+    myopia, astigmatism = agg.myopia_max, agg.astigmatism_max
+    middle = (thickness >= 300) & (k_max > 53)
+    conditions = [
+        (thickness >= 400) & (k_max > 48) & (myopia < 500) & (astigmatism < 500),
+        thickness >= 400,
+        middle & (800 <= myopia) & (myopia <= 1000) & (800 <= astigmatism) & (astigmatism <= 1000),
+        middle & (500 <= myopia) & (myopia < 800) & (500 <= astigmatism) & (astigmatism < 800),
+        middle,
+        thickness >= 300,
+        k_max > 55,
+    ]
+    return np.select(conditions, np.array(FOREIGN_STAGES, dtype=object), default='Advanced Keratoconus (Stage 3)')
+
+
+# 病情是否在进展：最大曲率上升超过 1，最薄点变薄超过 2%，近视度数变化超过 50
+def progress(agg):
+    return (agg.k_max_max > agg.k_max_min + 1) & (agg.thickness_min * 100 < agg.thickness_max * 98) & (
+            agg.myopia_max - agg.myopia_min > 50)
+
+
+# 读取汇总表，返回 (用户 id 数组, Aggregates)；不指定 user_id 时取出全部用户
+def load_aggregates(user_id=None):
+    query = db.session.query(CorneaAggregate.user_id, *[getattr(CorneaAggregate, name) for name in Aggregates._fields])
+    if user_id is not None:
+        query = query.filter(CorneaAggregate.user_id == user_id)
+    rows = query.all()
+    columns = list(zip(*rows)) if rows else [()] * (len(Aggregates._fields) + 1)
+    return np.array(columns[0], dtype=np.int64), Aggregates(*[np.array(values, dtype=float) for values in columns[1:]])
+
+
+# 读取趋势表中的进展标记，返回 {用户 id: 是否进展}；趋势考虑了数据的先后顺序，优先于 progress 的结果
+def load_progressing(user_id=None):
+    query = db.session.query(CorneaTrend.user_id, CorneaTrend.progressing)
+    if user_id is not None:
+        query = query.filter(CorneaTrend.user_id == user_id)
+    return dict(query.all())
+
+
+def stage_aggregates(agg, language):
+    return stage_zh(agg) if language == 'zh' else stage_foreign(agg), progress(agg)
+
+
+# 单个用户的诊断结果，只读取一行汇总数据，没有数据时返回空字典
+def diagnose(user_id, language):
+    user_ids, agg = load_aggregates(user_id)
+    if not len(user_ids):
+        return {}
+    stages, progressing = stage_aggregates(agg, language)
+    progress = load_progressing(user_id).get(user_id, progressing[0])
+    return dict(stage=stages[0], treatment=treat(stages[0]), progress=bool(progress))
+
+
+# 筛查全部用户，返回 [(用户 id, 分期, 是否进展)]
+def screen(language):
+    user_ids, agg = load_aggregates()
+    stages, progressing = stage_aggregates(agg, language)
+    trends = load_progressing()
+    user_ids = user_ids.tolist()
+    progressing = [bool(trends.get(user_id, progress)) for user_id, progress in zip(user_ids, progressing.tolist())]
+    return list(zip(user_ids, stages.tolist(), progressing))
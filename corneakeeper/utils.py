@@ -8,13 +8,22 @@ import re
 import uuid
 import PIL
 from PIL import Image
-from flask import request, redirect, url_for, current_app, flash
+from flask import request, redirect, url_for, current_app, flash, Request
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, BadSignature, SignatureExpired
 from corneakeeper.models import User
 from corneakeeper.extensions import db
 from corneakeeper.settings import Operations
 
 
+# 批量导入接口使用单独的上传大小上限
+class CorneaKeeperRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'user.import_data':
+            return current_app.config['CK_IMPORT_MAX_SIZE']
+        return super(CorneaKeeperRequest, self).max_content_length
+
+
 def is_safe_url(target):
     ref_url = urlparse(request.host_url)
     test_url = urlparse(urljoin(request.host_url, target))
@@ -100,70 +109,51 @@ def get_file_content(path):
         return f.read()
 
 
-def post_processing(result):
-    string_text = ""  # 字符串处理
-    string_list = []  # 列表处理
+# 识别结果中的标签 -> (字段, 数值类型)，标签已去掉括号和空白，同一字段取各标签数值的最大值
+OCR_LABELS = {
+    'K1': ('k1', float), 'k1': ('k1', float),
+    'K2': ('k2', float), 'k2': ('k2', float),
+    'KMax.Front': ('k_max', float), 'KMaxFront': ('k_max', float),
+    '最大K值.前表面': ('k_max', float), '最大K值前表面': ('k_max', float),
+    'ThinnestLocat': ('thickness_min', int), '最薄点': ('thickness_min', int),
+}
+OCR_FIELDS = (('k1', 0.), ('k2', 0.), ('k_max', 0.), ('thickness_min', 0))
+
+_OCR_NOISE = re.compile('[(（）)\\s]')  # 括号和空白
+_OCR_UNITS = re.compile('[a-zA-Z\u4e00-\u9fa5]')  # 数值后的单位
+
+
+# 把识别出的每行文字按冒号切分为词，去掉括号和空白；以中文开头、D 结尾的词在第一个数字处拆成标签和数值
+def ocr_tokens(result):
     for item in result['words_result']:
-        str = item['words'].replace('：', ':')
-        string_text += str
-        word = str.split(':')
-        for _ in word:
-            if len(_):
-                if _[-1] == 'D' and u'\u4e00' <= _[0] <= u'\u9fa5':
-                    pos = 0
-                    for i in range(0, len(_)):
-                        if _[i].isdigit():
-                            pos = i
-                            break
-                    string_list.append(re.sub('[(（）)\\s]', '', _[:pos]))
-                    string_list.append(re.sub('[(（）)\\s]', '', _[pos:]))
-                else:
-                    string_list.append(re.sub('[(（）)\\s]', '', _))  # 特殊字符处理
-    k1, k2, k_max, thickness_min = 0., 0., 0., 0
-    # k1 判断
-    if 'K1' in string_list:
-        k1 = max(k1, float(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                  string_list[string_list.index('K1') + 1])))
-    if 'k1' in string_list:
-        k1 = max(k1, float(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                  string_list[string_list.index('k1') + 1])))
-    # k2 判断
-    if 'K2' in string_list:
-        k2 = max(k2, float(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                  string_list[string_list.index('K2') + 1])))
-    if 'k2' in string_list:
-        k2 = max(k2, float(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                  string_list[string_list.index('k2') + 1])))
-
-    # k max
-    if 'KMax.Front' in string_list:
-        k_max = max(k_max, float(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                        string_list[string_list.index('KMax.Front') + 1])))
-    if 'KMaxFront' in string_list:
-        k_max = max(k_max, float(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                        string_list[string_list.index('KMaxFront') + 1])))
-    if '最大K值.前表面' in string_list:
-        k_max = max(k_max, float(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                        string_list[string_list.index('最大K值.前表面') + 1])))
-    if '最大K值前表面' in string_list:
-        k_max = max(k_max, float(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                        string_list[string_list.index('最大K值前表面') + 1])))
-
-    # thickness_min
-    if 'ThinnestLocat' in string_list:
-        thickness_min = max(thickness_min, int(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                                      string_list[string_list.index('ThinnestLocat') + 1])))
-    if '最薄点' in string_list:
-        thickness_min = max(thickness_min, int(re.sub('[a-zA-Z\u4e00-\u9fa5]', '',
-                                                      string_list[string_list.index('最薄点') + 1])))
-    ans = dict(
-        k1=k1,
-        k2=k2,
-        k_max=k_max,
-        thickness_min=thickness_min
-    )
-
-    return ans
+        for token in item['words'].replace('：', ':').split(':'):
+            if not token:
+                continue
+            if token[-1] == 'D' and '\u4e00' <= token[0] <= '\u9fa5':
+                pos = next((i for i, char in enumerate(token) if char.isdigit()), 0)
+                yield _OCR_NOISE.sub('', token[:pos])
+                yield _OCR_NOISE.sub('', token[pos:])
+            else:
+                yield _OCR_NOISE.sub('', token)
+
+
+# 一次遍历识别结果，每个标签取第一次出现时紧跟的词作为数值；缺少数值或数值无法解析的标签被忽略
+def post_processing(result):
+    fields = dict(OCR_FIELDS)
+    seen = set()
+    label = None
+    for token in ocr_tokens(result):
+        if label is not None:
+            field, kind = OCR_LABELS[label]
+            try:
+                fields[field] = max(fields[field], kind(_OCR_UNITS.sub('', token)))
+            except ValueError:
+                pass
+        label = None
+        if token in OCR_LABELS and token not in seen:
+            label = token
+            seen.add(token)
+    return fields
 
 
 #  根据不同定级给出相关治疗意见